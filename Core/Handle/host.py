@@ -69,6 +69,7 @@ class Host(object):
         defaultdict = {'ipaddress': ipaddress, }  # 没有主机数据时新建
         model, created = HostModel.objects.get_or_create(ipaddress=ipaddress, defaults=defaultdict)
         if created is True:
+            Xcache.incr_data_version(Xcache.DATA_VERSION_HOSTS)
             result = HostSerializer(model, many=False).data
             return result  # 新建后直接返回
         # 有历史数据
@@ -101,6 +102,7 @@ class Host(object):
         defaultdict = {'id': id, 'tag': tag, 'comment': comment}  # 没有此主机数据时新建
         model, created = HostModel.objects.get_or_create(id=id, defaults=defaultdict)
         if created is True:
+            Xcache.incr_data_version(Xcache.DATA_VERSION_HOSTS)
             result = HostSerializer(model, many=False).data
             return result  # 新建后直接返回
         # 有历史数据
@@ -110,6 +112,7 @@ class Host(object):
                 model.tag = tag
                 model.comment = comment
                 model.save()
+                Xcache.incr_data_version(Xcache.DATA_VERSION_HOSTS)
                 result = HostSerializer(model, many=False).data
                 return result
             except Exception as E:
@@ -127,22 +130,29 @@ class Host(object):
 
     @staticmethod
     def destory_mulit(hids):
-        for hid in hids:
-            Host.destory_host(hid)
+        hosts = HostSerializer(HostModel.objects.filter(id__in=hids), many=True).data
+        # 批量删除相关缓存信息
+        Xcache.del_hosts_cache(hosts)
+        try:
+            # 删除主表信息
+            HostModel.objects.filter(id__in=hids).delete()
+            # 删除关联表信息
+            for OneModel in Host.REGISTER_DESTORY:
+                OneModel.objects.filter(hid__in=hids).delete()
+        except Exception as E:
+            logger.error(E)
+        Xcache.incr_data_version(Xcache.DATA_VERSION_HOSTS)
 
         context = data_return(202, Host_MSG.get(202), {})
         return context
 
     @staticmethod
     def destory_host(id=None):
-        # 删除相关缓存信息
         host = Host.get_by_hid(hid=id)
-        # 删除缓存的session命令行结果
-        Xcache.del_sessionio_cache(hid=id)
-        # 删除缓存的模块结果
-        Xcache.del_module_result_by_hid(ipaddress=host.get("ipaddress"))
-        # 删除缓存的模块历史结果
-        Xcache.del_module_result_history_by_hid(ipaddress=host.get("ipaddress"))
+        if host is None:
+            return False
+        # 删除相关缓存信息(session命令行结果,模块结果,模块历史结果)
+        Xcache.del_hosts_cache([host])
 
         try:
             # 删除主表信息
@@ -150,6 +160,7 @@ class Host(object):
             # 删除关联表信息
             for OneModel in Host.REGISTER_DESTORY:
                 OneModel.objects.filter(hid=id).delete()
+            Xcache.incr_data_version(Xcache.DATA_VERSION_HOSTS)
             return True
         except Exception as E:
             logger.error(E)
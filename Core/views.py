@@ -22,7 +22,11 @@ from Lib.notice import Notice
 class NoticesView(BaseView):
     def list(self, request, **kwargs):
         try:
-            context = Notice.list_notices()
+            start = int(request.query_params.get('start', 0))
+            count = request.query_params.get('count', None)
+            if count is not None:
+                count = int(count)
+            context = Notice.list_notices(start=start, count=count)
             context = data_return(200, CODE_MSG.get(200), context)
         except Exception as E:
             logger.error(E)
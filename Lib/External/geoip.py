@@ -3,31 +3,90 @@
 # @Date  : 2021/2/25
 # @Desc  :
 import os
+import threading
+import time
+from collections import OrderedDict
 
 import geoip2.database
 from django.conf import settings
 
+from Lib.configs import GEOIP_LRU_MAXSIZE, GEOIP_READER_CHECK_INTERVAL
 from Lib.log import logger
 from Lib.xcache import Xcache
 
 
 class Geoip(object):
+    CITY = "GeoLite2-City.mmdb"
+    ASN = "GeoLite2-ASN.mmdb"
+
+    # 进程内共享的reader,{mmdb: (mtime, reader)},文件更新后整体替换
+    _readers = {}
+    _readers_checked = {}
+    _readers_lock = threading.Lock()
+
+    # 进程内LRU,位于redis缓存之前,{(mmdb, ip): result}
+    _lru = OrderedDict()
+    _lru_lock = threading.Lock()
+
     def __init__(self):
         pass
 
     @staticmethod
-    def get_city(ip):
+    def _get_reader(mmdb):
+        """懒加载MODE_MMAP的reader,定期检查文件修改时间,更新后原子替换"""
+        now = time.time()
+        current = Geoip._readers.get(mmdb)
+        if current is not None and now - Geoip._readers_checked.get(mmdb, 0) < GEOIP_READER_CHECK_INTERVAL:
+            return current[1]
+
+        with Geoip._readers_lock:
+            current = Geoip._readers.get(mmdb)
+            if current is not None and now - Geoip._readers_checked.get(mmdb, 0) < GEOIP_READER_CHECK_INTERVAL:
+                return current[1]
+            Geoip._readers_checked[mmdb] = now
+            mmdb_dir = os.path.join(settings.BASE_DIR, 'STATICFILES', 'STATIC', mmdb)
+            try:
+                mtime = os.stat(mmdb_dir).st_mtime
+                if current is not None and current[0] == mtime:
+                    return current[1]
+                reader = geoip2.database.Reader(mmdb_dir, mode=geoip2.database.MODE_MMAP)
+            except Exception as E:
+                logger.exception(E)
+                return None if current is None else current[1]
+
+            # 旧reader可能仍在其他线程中使用,不主动close,由引用计数释放
+            Geoip._readers[mmdb] = (mtime, reader)
+            if current is not None:
+                Geoip._lru_clear(mmdb)
+            return reader
 
-        result = Xcache.get_city_reader_cache(ip)
-        if result is not None:
+    @staticmethod
+    def _lru_clear(mmdb):
+        with Geoip._lru_lock:
+            for key in [key for key in Geoip._lru if key[0] == mmdb]:
+                Geoip._lru.pop(key)
+
+    @staticmethod
+    def _lru_get(mmdb, ip):
+        with Geoip._lru_lock:
+            result = Geoip._lru.get((mmdb, ip))
+            if result is not None:
+                Geoip._lru.move_to_end((mmdb, ip))
             return result
-        city_mmdb_dir = os.path.join(settings.BASE_DIR, 'STATICFILES', 'STATIC', 'GeoLite2-City.mmdb')
-        city_reader = geoip2.database.Reader(city_mmdb_dir)
 
+    @staticmethod
+    def _lru_set(mmdb, ip, result):
+        with Geoip._lru_lock:
+            Geoip._lru[(mmdb, ip)] = result
+            Geoip._lru.move_to_end((mmdb, ip))
+            while len(Geoip._lru) > GEOIP_LRU_MAXSIZE:
+                Geoip._lru.popitem(last=False)
+
+    @staticmethod
+    def _read_city(city_reader, ip):
         try:
             response = city_reader.city(ip)
         except Exception as _:
-            Xcache.set_city_reader_cache(ip, "局域网")
             return "局域网"
         country = ""
         try:
@@ -54,23 +113,63 @@ class Geoip(object):
         if city is None:
             city = ""
         result = f"{country} {subdivision} {city}"
-        Xcache.set_city_reader_cache(ip, result)
         return result
 
     @staticmethod
-    def get_asn(ip):
+    def lookup_many(ips):
+        """批量查询ip所在城市,返回{ip: city}
+        依次查询进程内LRU,redis缓存(一次MGET),mmdb,新结果一次写回redis
+        """
+        result = {}
+        missing = []
+        for ip in set(ips):
+            city = Geoip._lru_get(Geoip.CITY, ip)
+            if city is not None:
+                result[ip] = city
+            else:
+                missing.append(ip)
+        if len(missing) == 0:
+            return result
 
-        asn_reader = Xcache.get_asn_reader_cache(ip)
-        if asn_reader is not None:
-            return asn_reader
+        cache_data = Xcache.get_city_reader_cache_many(missing)
+        new_data = {}
+        city_reader = None
+        for ip in missing:
+            city = cache_data.get(ip)
+            if city is None:
+                if city_reader is None:
+                    city_reader = Geoip._get_reader(Geoip.CITY)
+                if city_reader is None:  # mmdb不可用时不缓存
+                    result[ip] = ""
+                    continue
+                city = Geoip._read_city(city_reader, ip)
+                new_data[ip] = city
+            Geoip._lru_set(Geoip.CITY, ip, city)
+            result[ip] = city
+        Xcache.set_city_reader_cache_many(new_data)
+        return result
 
-        asn_mmdb_dir = os.path.join(settings.BASE_DIR, 'STATICFILES', 'STATIC', 'GeoLite2-ASN.mmdb')
-        asn_reader = geoip2.database.Reader(asn_mmdb_dir)
+    @staticmethod
+    def get_city(ip):
+        return Geoip.lookup_many([ip]).get(ip)
 
-        try:
-            response = asn_reader.asn(ip)
-        except Exception as _:
-            Xcache.set_asn_reader_cache(ip, "")
-            return ""
-        Xcache.set_asn_reader_cache(ip, response.autonomous_system_organization)
-        return response.autonomous_system_organization
+    @staticmethod
+    def get_asn(ip):
+        asn = Geoip._lru_get(Geoip.ASN, ip)
+        if asn is not None:
+            return asn
+
+        asn = Xcache.get_asn_reader_cache(ip)
+        if asn is None:
+            asn_reader = Geoip._get_reader(Geoip.ASN)
+            if asn_reader is None:
+                return ""
+            try:
+                asn = asn_reader.asn(ip).autonomous_system_organization
+            except Exception as _:
+                asn = ""
+            if asn is None:
+                asn = ""
+            Xcache.set_asn_reader_cache(ip, asn)
+        Geoip._lru_set(Geoip.ASN, ip, asn)
+        return asn
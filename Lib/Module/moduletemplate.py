@@ -56,6 +56,10 @@ class _CommonModule(object):
     # bot类模块描述
     SEARCH = ''
 
+    # 日志缓冲区配置,超过任一阈值时写入redis
+    LOG_BUFFER_SIZE = 4096  # 字节
+    LOG_BUFFER_INTERVAL = 1  # 秒
+
     def __init__(self, custom_param):
 
         super().__init__()  # 父类无需入参
@@ -66,6 +70,23 @@ class _CommonModule(object):
         self._port = None  # 补齐默认参数,为了Serializer
         self._protocol = None  # 补齐默认参数,为了Serializer
         self.opts = {}
+        self._log_buffer = []
+        self._log_buffer_length = 0
+        self._log_buffer_flush_time = time.time()
+        self._log_lock = threading.Lock()  # 模块线程与监控循环共用缓冲区
+
+    def __getstate__(self):
+        """模块实例会被序列化(任务注册表,bot等待队列),锁不可序列化"""
+        state = self.__dict__.copy()
+        state.pop("_log_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault("_log_buffer", [])
+        self.__dict__.setdefault("_log_buffer_length", 0)
+        self.__dict__.setdefault("_log_buffer_flush_time", time.time())
+        self._log_lock = threading.Lock()
 
     # 公用函数
     def check(self):
@@ -170,40 +191,68 @@ class _CommonModule(object):
 
     # 存储结果函数集
     def clean_log(self):
-        flag = Xcache.set_module_result(self.host_ipaddress, self.loadpath, "")
+        with self._log_lock:
+            self._log_buffer = []
+            self._log_buffer_length = 0
+            flag = Xcache.set_module_result(self.host_ipaddress, self.loadpath, "")
         return flag
 
     def store_log(self, result_format):
         """API:存储结果到数据库"""
         result_format = result_format.strip()
-        Xcache.set_module_result(self.host_ipaddress, self.loadpath, result_format)
+        with self._log_lock:
+            self._log_buffer = []
+            self._log_buffer_length = 0
+            Xcache.set_module_result(self.host_ipaddress, self.loadpath, result_format)
+
+    def _append_log(self, result_format):
+        """日志先写入进程内缓冲区,超过大小或时间阈值时批量APPEND到redis"""
+        with self._log_lock:
+            self._log_buffer.append(result_format)
+            self._log_buffer_length += len(result_format)
+            if self._log_buffer_length >= self.LOG_BUFFER_SIZE or \
+                    time.time() - self._log_buffer_flush_time >= self.LOG_BUFFER_INTERVAL:
+                self._flush_log_locked()
+
+    def _flush_log(self):
+        with self._log_lock:
+            self._flush_log_locked()
+
+    def _flush_log_locked(self):
+        """调用方需持有_log_lock,持锁写入redis保证多个线程的日志顺序"""
+        log_buffer, self._log_buffer = self._log_buffer, []
+        self._log_buffer_length = 0
+        self._log_buffer_flush_time = time.time()
+        if len(log_buffer) > 0:
+            Xcache.add_module_result(self.host_ipaddress, self.loadpath, "".join(log_buffer))
 
     def log_raw(self, result_line):
         if not result_line.endswith('\n'):
             result_line = "{}\n".format(result_line)
-        Xcache.add_module_result(self.host_ipaddress, self.loadpath, result_line)
+        self._append_log(result_line)
 
     def log_status(self, result_line):
         result_format = "[*] {} \n".format(result_line)
-        Xcache.add_module_result(self.host_ipaddress, self.loadpath, result_format)
+        self._append_log(result_format)
 
     def log_good(self, result_line):
         result_format = "[+] {} \n".format(result_line)
-        Xcache.add_module_result(self.host_ipaddress, self.loadpath, result_format)
+        self._append_log(result_format)
 
     def log_warning(self, result_line):
         result_format = "[!] {} \n".format(result_line)
-        Xcache.add_module_result(self.host_ipaddress, self.loadpath, result_format)
+        self._append_log(result_format)
 
     def log_error(self, result_line):
         result_format = "[-] {} \n".format(result_line)
-        Xcache.add_module_result(self.host_ipaddress, self.loadpath, result_format)
+        self._append_log(result_format)
 
     def log_except(self, result_line):
         result_format = "[x] {} \n".format(result_line)
-        Xcache.add_module_result(self.host_ipaddress, self.loadpath, result_format)
+        self._append_log(result_format)
 
     def _store_result_in_history(self):
+        self._flush_log()
         # 特殊处理
         if self.MODULETYPE in [TAG2CH.internal]:
             return None
@@ -619,7 +668,10 @@ class PostPythonModule(_PostCommonModule):
             elif t1.is_alive() is not True:
                 break
             else:
+                # 模块长时间无新日志时,缓冲区中的日志也能在1秒内写入
+                self._flush_log()
                 time.sleep(1)
+        self._flush_log()
 
 
 # 后台运行模板
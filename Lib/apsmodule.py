@@ -3,7 +3,6 @@
 # @Date  : 2021/2/26
 # @Desc  :
 import threading
-import time
 import uuid
 
 from apscheduler.events import EVENT_JOB_ADDED, EVENT_JOB_REMOVED, EVENT_JOB_MODIFIED, EVENT_JOB_EXECUTED, \
@@ -11,8 +10,8 @@ from apscheduler.events import EVENT_JOB_ADDED, EVENT_JOB_REMOVED, EVENT_JOB_MOD
 from apscheduler.schedulers.background import BackgroundScheduler
 
 from Lib.log import logger
+from Lib.moduletask import ModuleTask
 from Lib.notice import Notice
-from Lib.xcache import Xcache
 
 
 class APSModule(object):
@@ -46,15 +45,8 @@ class APSModule(object):
             post_module_intent.module_self_uuid = tmp_self_uuid
             self.ModuleJobsScheduler.add_job(func=post_module_intent._thread_run, max_instances=1, id=tmp_self_uuid)
 
-            # 放入缓存队列,用于后续删除任务,存储结果等
-            req = {
-                'broker': post_module_intent.MODULE_BROKER,
-                'uuid': tmp_self_uuid,
-                'module': post_module_intent,
-                'time': int(time.time()),
-                'job_id': None,
-            }
-            Xcache.create_module_task(req)
+            # 放入任务注册表,用于后续删除任务,存储结果等
+            ModuleTask.create(module_intent=post_module_intent, task_uuid=tmp_self_uuid, job_id=None)
             Notice.send_info(
                 "模块: {} {} 开始执行".format(post_module_intent.NAME, post_module_intent.target_str))
             return True
@@ -93,10 +85,22 @@ class APSModule(object):
 
     @staticmethod
     def store_executed_result(task_uuid=None):
-        req = Xcache.get_module_task_by_uuid(task_uuid=task_uuid)
+        req = ModuleTask.get(task_uuid=task_uuid)
         if req is None:
-            logger.warning("缓存中无对应实例,可能已经模块已经中途退出")
-            return False
+            # 任务已被其他进程删除(实例只保存在本进程),由本进程保存已生成的结果
+            module_common_instance = ModuleTask.pop_instance(task_uuid)
+            if module_common_instance is None:
+                logger.warning("缓存中无对应实例,可能已经模块已经中途退出")
+                return False
+            try:
+                module_common_instance.log_status("用户手动删除任务")
+                module_common_instance._store_result_in_history()
+            except Exception as E:
+                logger.error(E)
+                return False
+            Notice.send_info(
+                "模块: {} {} 手动删除".format(module_common_instance.NAME, module_common_instance.target_str))
+            return True
         module_common_instance = req.get("module")
 
         # 存储运行结果
@@ -105,10 +109,10 @@ class APSModule(object):
             Notice.send_success(
                 "模块: {} {} 执行完成".format(module_common_instance.NAME, module_common_instance.target_str))
             logger.warning("多模块实例执行完成:{}".format(module_common_instance.NAME))
-            Xcache.del_module_task_by_uuid(task_uuid=task_uuid)  # 清理缓存信息
+            ModuleTask.delete(task_uuid=task_uuid)  # 清理缓存信息
             return True
         except Exception as E:
-            Xcache.del_module_task_by_uuid(task_uuid=task_uuid)  # 清理缓存信息
+            ModuleTask.delete(task_uuid=task_uuid)  # 清理缓存信息
             logger.error("多模块实例执行异常:{} 异常信息: {}".format(module_common_instance.NAME, E))
             Notice.send_exception("模块: {} 执行异常,异常信息: {}".format(module_common_instance.NAME, E))
             logger.error(E)
@@ -116,9 +120,15 @@ class APSModule(object):
 
     @staticmethod
     def store_error_result(task_uuid=None, exception=None):
-        req = Xcache.get_module_task_by_uuid(task_uuid=task_uuid)
-        Xcache.del_module_task_by_uuid(task_uuid=task_uuid)  # 清理缓存信息
-        module_common_instance = req.get("module")
+        req = ModuleTask.get(task_uuid=task_uuid)
+        ModuleTask.delete(task_uuid=task_uuid)  # 清理缓存信息
+        if req is None:
+            # 任务已被其他进程删除,使用本进程内的实例
+            module_common_instance = ModuleTask.pop_instance(task_uuid)
+            if module_common_instance is None:
+                return False
+        else:
+            module_common_instance = req.get("module")
 
         # 存储运行结果
         try:
@@ -134,8 +144,8 @@ class APSModule(object):
             return False
 
     def delete_job_by_uuid(self, task_uuid=None):
-        req = Xcache.get_module_task_by_uuid(task_uuid=task_uuid)
-        Xcache.del_module_task_by_uuid(task_uuid=task_uuid)  # 清理缓存信息
+        req = ModuleTask.get(task_uuid=task_uuid)
+        ModuleTask.delete(task_uuid=task_uuid)  # 清理缓存信息
 
         # 删除后台任务
         try:
@@ -148,6 +158,9 @@ class APSModule(object):
         except Exception as E:
             logger.error(E)
             return False
+        if module_common_instance is None:
+            # 实例在其他进程中运行,该进程的模块线程检测到任务删除后退出并保存结果
+            return True
 
         # 存储已经生成的结果
         try:
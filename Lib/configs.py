@@ -422,6 +422,60 @@ MSF_RPC_DATA_CHANNEL = "MSF_RPC_DATA_CHANNEL"
 MSF_RPC_LOG_CHANNEL = "MSF_RPC_LOG_CHANNEL"
 MSF_RPC_CONSOLE_CHANNEL = "MSF_RPC_CONSOLE_CHANNEL"
 VIPER_SEND_SMS_CHANNEL = "VIPER_SEND_SMS_CHANNEL"
+XCACHE_LOCAL_INVALIDATE_CHANNEL = "XCACHE_LOCAL_INVALIDATE_CHANNEL"
+VIPER_MODULE_TASK_CHANNEL = "VIPER_MODULE_TASK_CHANNEL"
+VIPER_DATA_VERSION_CHANNEL = "VIPER_DATA_VERSION_CHANNEL"
+VIPER_SESSION_EVENT_CHANNEL = "VIPER_SESSION_EVENT_CHANNEL"
+
+# 后台任务创建等待配置
+MODULE_TASK_WAIT_TIMEOUT = 2  # 秒,同步等待任务创建的最长时间
+MODULE_TASK_PENDING_TIMEOUT = 30  # 秒,任务创建前到达的回调最长缓存时间
+
+# 进程内缓存配置
+LOCAL_CACHE_TTL = 60  # 秒,订阅异常时的兜底过期时间
+LOCAL_CACHE_MAXSIZE = 128
+
+# 模块历史结果最大保存条数
+MODULE_RESULT_HISTORY_MAXLEN = 1000
+
+# 通知最大保存条数
+NOTICES_MAXLEN = 1000
+
+# session事件流最大保存条数,超过SESSION_CHECKIN_STALE秒未回连视为失联
+SESSION_EVENTS_MAXLEN = 1000
+SESSION_CHECKIN_STALE = 120
+
+# 每个主机Session命令行结果缓存的最大字节数
+SESSIONIO_CACHE_MAXBYTES = 256 * 1024
+
+# msfrpc连接池大小(调度线程,请求线程及并发调用共用),连接超时(秒)
+MSFRPC_POOL_SIZE = 10
+MSFRPC_CONNECT_TIMEOUT = 1.05
+# 只读msfrpc方法(JobList,SessionList)结果的复用时间(秒),0为关闭
+MSFRPC_MEMO_TTL = 0.5
+# msfrpc熔断:连续失败MSFRPC_BREAKER_FAILURES次后熔断,期间调用立即返回,每MSFRPC_BREAKER_PROBE_INTERVAL秒放行一次探测
+MSFRPC_BREAKER_FAILURES = 3
+MSFRPC_BREAKER_PROBE_INTERVAL = 5
+# msfrpc调用耗时统计的直方图分桶上限(毫秒),超过最后一个分桶计入inf
+MSFRPC_METRICS_BUCKETS = [10, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+# 调用统计先在进程内累加,每MSFRPC_METRICS_FLUSH_INTERVAL秒写入redis一次
+MSFRPC_METRICS_FLUSH_INTERVAL = 5
+
+# 心跳连续无变化HEARTBEAT_IDLE_TICKS次后间隔加倍,最大HEARTBEAT_MAX_INTERVAL秒
+HEARTBEAT_IDLE_TICKS = 5
+HEARTBEAT_MAX_INTERVAL = 8
+# 心跳中事件触发部分的兜底检查间隔(秒),订阅消息丢失时保证数据最终一致
+HEARTBEAT_EVENT_CHECK_INTERVAL = 5
+# 数据版本号变化事件触发的心跳计算延迟(秒),期间同一部分的多次事件合并为一次计算
+HEARTBEAT_EVENT_DEBOUNCE = 0.2
+# 客户端连接时直接使用监控进程最近一次的心跳快照,超过该时间(秒)则重新计算
+HEARTBEAT_SNAPSHOT_MAX_AGE = 10
+# 心跳客户端登记的有效期(秒),客户端收到每HEARTBEAT_EVENT_CHECK_INTERVAL秒一次的ping时续期
+HEARTBEAT_SUBSCRIBER_TTL = 30
+
+# GeoIP进程内缓存条数及mmdb文件更新检查间隔(秒)
+GEOIP_LRU_MAXSIZE = 4096
+GEOIP_READER_CHECK_INTERVAL = 60
 
 PAYLOAD_LOADER_STORE_PATH = "STATICFILES/STATIC/SHELLCODELOADER/"
 
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# @File  : moduletask.py
+# @Date  : 2021/3/2
+# @Desc  :
+import hashlib
+import json
+import threading
+import time
+
+from Lib.Module.configs import HANDLER_OPTION, BROKER
+from Lib.configs import MODULE_TASK_WAIT_TIMEOUT, MODULE_TASK_PENDING_TIMEOUT
+from Lib.log import logger
+from Lib.xcache import Xcache
+from Msgrpc.serializers import PostModuleSerializer
+
+
+class ModuleTask(object):
+    """后台任务注册表
+    redis中只保存精简的任务描述(列表,心跳等使用),模块实例保存在创建任务的进程内存中,
+    只有msf模块(回调由MainMonitor进程处理)才在redis中保存序列化的实例
+    """
+    SCHEMA_VERSION = 1
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    _events = {}  # 等待任务创建的线程, {task_uuid: threading.Event}
+    _pending = {}  # 任务创建前到达的回调, {task_uuid: [(expire_time, func, args)]}
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def create(module_intent=None, task_uuid=None, job_id=None):
+        moduleinfo = dict(PostModuleSerializer(module_intent, many=False).data)
+        moduleinfo['_custom_param'] = ModuleTask._deal_dynamic_param(moduleinfo.get('_custom_param'))
+        req = {
+            'version': ModuleTask.SCHEMA_VERSION,
+            'broker': module_intent.MODULE_BROKER,
+            'uuid': task_uuid,
+            'job_id': job_id,
+            'loadpath': module_intent.loadpath,
+            'name': module_intent.NAME,
+            'target': module_intent.target_str,
+            'time': int(time.time()),
+            'params_digest': ModuleTask._params_digest(module_intent._custom_param),
+            'moduleinfo': moduleinfo,
+        }
+        # python模块在本进程的调度器中运行并处理结果,只保留进程内实例;msf模块的回调由MainMonitor进程处理
+        if module_intent.MODULE_BROKER == BROKER.post_python_job:
+            with ModuleTask._instances_lock:
+                ModuleTask._instances[task_uuid] = module_intent
+            Xcache.create_module_task(req)
+        else:
+            Xcache.create_module_task(req, module_intent)
+        ModuleTask.notify_created(task_uuid)
+        return req
+
+    @staticmethod
+    def notify_created(task_uuid=None):
+        """任务已写入redis,唤醒等待的线程并执行缓存的回调"""
+        with ModuleTask._instances_lock:
+            event = ModuleTask._events.get(task_uuid)
+            pendings = ModuleTask._pending.pop(task_uuid, [])
+        if event is not None:
+            event.set()
+        now = time.time()
+        for expire_time, func, args in pendings:
+            if expire_time < now:
+                continue
+            try:
+                func(*args)
+            except Exception as E:
+                logger.exception(E)
+
+    @staticmethod
+    def notify_created_from_sub(message=None):
+        task_uuid = message.get('data').decode('utf-8')
+        ModuleTask.notify_created(task_uuid)
+
+    @staticmethod
+    def defer(task_uuid, func, *args):
+        """任务尚未创建时缓存回调,任务创建后再执行,超时后丢弃"""
+        now = time.time()
+        with ModuleTask._instances_lock:
+            for one_uuid in list(ModuleTask._pending.keys()):
+                pendings = [one for one in ModuleTask._pending[one_uuid] if one[0] >= now]
+                if len(pendings) == 0:
+                    logger.error(f"等待任务创建超时,丢弃回调: {one_uuid}")
+                    ModuleTask._pending.pop(one_uuid)
+                else:
+                    ModuleTask._pending[one_uuid] = pendings
+            ModuleTask._pending.setdefault(task_uuid, []).append((now + MODULE_TASK_PENDING_TIMEOUT, func, args))
+        # 缓存期间任务可能已经创建
+        if Xcache.get_module_task_by_uuid_nowait(task_uuid) is not None:
+            ModuleTask.notify_created(task_uuid)
+        return True
+
+    @staticmethod
+    def list():
+        reqs = []
+        for req in Xcache.list_module_tasks():
+            if req.get("version") != ModuleTask.SCHEMA_VERSION:
+                logger.warning(f"清除旧版本的任务: {req.get('uuid')}")
+                ModuleTask.delete(req.get("uuid"))
+                continue
+            reqs.append(req)
+        return reqs
+
+    @staticmethod
+    def _wait_created(task_uuid=None, timeout=MODULE_TASK_WAIT_TIMEOUT):
+        """等待任务创建通知,任务创建后立即返回"""
+        with ModuleTask._instances_lock:
+            event = ModuleTask._events.setdefault(task_uuid, threading.Event())
+        try:
+            # 创建event后再检查一次,避免错过通知
+            req = Xcache.get_module_task_by_uuid_nowait(task_uuid)
+            if req is None and event.wait(timeout):
+                req = Xcache.get_module_task_by_uuid_nowait(task_uuid)
+            return req
+        finally:
+            with ModuleTask._instances_lock:
+                ModuleTask._events.pop(task_uuid, None)
+
+    @staticmethod
+    def get(task_uuid=None, timeout=MODULE_TASK_WAIT_TIMEOUT):
+        """获取任务描述及模块实例,优先使用本进程内的实例
+        任务尚未创建时最多等待timeout秒,timeout为0时不等待
+        """
+        req = Xcache.get_module_task_by_uuid_nowait(task_uuid)
+        if req is None and timeout > 0:
+            req = ModuleTask._wait_created(task_uuid, timeout)
+        if req is None:
+            # 任务已被删除,本进程内的实例由pop_instance取出
+            return None
+        with ModuleTask._instances_lock:
+            module_intent = ModuleTask._instances.get(task_uuid)
+        if module_intent is None:
+            module_intent = Xcache.get_module_task_instance(task_uuid)
+        req = dict(req)
+        req['module'] = module_intent
+        return req
+
+    @staticmethod
+    def pop_instance(task_uuid=None):
+        """取出本进程内的模块实例(任务描述可能已被其他进程删除)"""
+        with ModuleTask._instances_lock:
+            return ModuleTask._instances.pop(task_uuid, None)
+
+    @staticmethod
+    def delete(task_uuid=None):
+        with ModuleTask._instances_lock:
+            ModuleTask._instances.pop(task_uuid, None)
+        Xcache.del_module_task_by_uuid(task_uuid=task_uuid)
+
+    @staticmethod
+    def _params_digest(_custom_param=None):
+        try:
+            data = json.dumps(_custom_param, sort_keys=True, default=str)
+        except Exception as E:
+            logger.warning(E)
+            data = str(_custom_param)
+        return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _deal_dynamic_param(_custom_param=None):
+        """处理handler及凭证等动态变化参数,返回处理后参数列表"""
+        if _custom_param is None:
+            return None
+        _custom_param = dict(_custom_param)
+        if _custom_param.get(HANDLER_OPTION.get("name")) is not None:
+            new_option = {}
+            old_option = json.loads(_custom_param.get(HANDLER_OPTION.get("name")))
+            new_option["PAYLOAD"] = old_option.get("PAYLOAD")
+            new_option["LHOST"] = old_option.get("LHOST")
+            new_option["RHOST"] = old_option.get("RHOST")
+            new_option["LPORT"] = old_option.get("LPORT")
+            _custom_param[HANDLER_OPTION.get("name")] = json.dumps(new_option)
+
+        return _custom_param
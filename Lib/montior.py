@@ -6,17 +6,18 @@ import datetime
 import logging
 import socket
 
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 
 from Core.Handle.setting import Settings
 from Lib.Module.moduletemplate import BROKER
 from Lib.configs import *
 from Lib.log import logger
+from Lib.moduletask import ModuleTask
 from Lib.msfmodule import MSFModule
 from Lib.notice import Notice
 from Lib.redisclient import RedisClient
+from Lib.sessiontracker import SessionTracker
 from Lib.xcache import Xcache
 from Msgrpc.Handle.handler import Handler
 from PostModule.Handle.postmoduleconfig import PostModuleConfig
@@ -47,7 +48,8 @@ class MainMonitor(object):
         log = logging.getLogger('apscheduler.scheduler')
         log.setLevel(logging.ERROR)
 
-        self.MainScheduler = BackgroundScheduler()
+        # 常驻的订阅线程会一直占用线程池,默认10个线程不足
+        self.MainScheduler = BackgroundScheduler(executors={'default': ThreadPoolExecutor(20)})
 
         # msf模块result数据监听线程
         self.MainScheduler.add_job(func=self.sub_msf_module_result_thread,
@@ -67,11 +69,37 @@ class MainMonitor(object):
                                    trigger='interval',
                                    seconds=1, id='sub_msf_module_log_thread')
 
-        # 心跳线程
-        self.MainScheduler.add_job(func=self.sub_heartbeat_thread,
+        # 后台任务创建通知监听线程
+        self.MainScheduler.add_job(func=self.sub_module_task_thread,
+                                   max_instances=1,
+                                   trigger='interval',
+                                   seconds=1, id='sub_module_task_thread')
+
+        # 心跳:数据来自msfrpc的部分各自轮询,互不阻塞
+        for section in HeartBeat.POLLED_SECTIONS:
+            self.MainScheduler.add_job(func=HeartBeat.poll,
+                                       args=[section],
+                                       max_instances=1,
+                                       trigger='interval',
+                                       seconds=1, id=f'heartbeat_poll_{section}')
+
+        # 心跳:其他部分由数据版本号变化事件触发
+        self.MainScheduler.add_job(func=self.sub_data_version_thread,
+                                   max_instances=1,
+                                   trigger='interval',
+                                   seconds=1, id='sub_data_version_thread')
+
+        # session事件监听线程(session监控通知)
+        self.MainScheduler.add_job(func=self.sub_session_event_thread,
+                                   max_instances=1,
+                                   trigger='interval',
+                                   seconds=1, id='sub_session_event_thread')
+
+        # 心跳:事件部分的兜底检查
+        self.MainScheduler.add_job(func=HeartBeat.check_events,
                                    max_instances=1,
                                    trigger='interval',
-                                   seconds=1, id='sub_heartbeat_thread')
+                                   seconds=HEARTBEAT_EVENT_CHECK_INTERVAL, id='heartbeat_check_events')
 
         # send_sms线程
         self.MainScheduler.add_job(func=self.sub_send_sms_thread,
@@ -117,17 +145,28 @@ class MainMonitor(object):
             logger.error("unknow broker")
 
     @staticmethod
-    def sub_heartbeat_thread():
-        channel_layer = get_channel_layer()
-
-        result = HeartBeat.get_heartbeat_result()
-        async_to_sync(channel_layer.group_send)(
-            "heartbeat",
-            {
-                'type': 'send.message',
-                'message': result
-            }
-        )
+    def sub_data_version_thread():
+        """这个函数必须以线程的方式运行,监控数据版本号变化消息,触发心跳中对应部分"""
+        rcon = RedisClient.get_result_connection()
+        if rcon is None:
+            return
+        ps = rcon.pubsub(ignore_subscribe_messages=True)
+        ps.subscribe(**{VIPER_DATA_VERSION_CHANNEL: HeartBeat.on_data_version_changed})
+        for message in ps.listen():
+            if message:
+                logger.warning("不应获取非空message {}".format(message))
+
+    @staticmethod
+    def sub_session_event_thread():
+        """这个函数必须以线程的方式运行,监控session生命周期事件"""
+        rcon = RedisClient.get_result_connection()
+        if rcon is None:
+            return
+        ps = rcon.pubsub(ignore_subscribe_messages=True)
+        ps.subscribe(**{VIPER_SESSION_EVENT_CHANNEL: SessionTracker.notify_from_sub})
+        for message in ps.listen():
+            if message:
+                logger.warning("不应获取非空message {}".format(message))
 
     @staticmethod
     def sub_send_sms_thread():
@@ -142,6 +181,18 @@ class MainMonitor(object):
             if message:
                 logger.warning("不应获取非空message {}".format(message))
 
+    @staticmethod
+    def sub_module_task_thread():
+        """这个函数必须以线程的方式运行,监控后台任务创建消息,唤醒等待任务创建的回调"""
+        rcon = RedisClient.get_result_connection()
+        if rcon is None:
+            return
+        ps = rcon.pubsub(ignore_subscribe_messages=True)
+        ps.subscribe(**{VIPER_MODULE_TASK_CHANNEL: ModuleTask.notify_created_from_sub})
+        for message in ps.listen():
+            if message:
+                logger.warning("不应获取非空message {}".format(message))
+
     @staticmethod
     def sub_msf_module_result_thread():
         """这个函数必须以线程的方式运行,监控msf发送的redis消息,获取job类任务推送的结果"""
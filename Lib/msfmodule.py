@@ -3,13 +3,12 @@
 # @Date  : 2021/2/26
 # @Desc  :
 import json
-import time
 
 from Lib.log import logger
 from Lib.method import Method
+from Lib.moduletask import ModuleTask
 from Lib.notice import Notice
 from Lib.rpcclient import RpcClient
-from Lib.xcache import Xcache
 
 
 class MSFModule(object):
@@ -58,15 +57,8 @@ class MSFModule(object):
         else:
             logger.warning(
                 "模块实例放入列表:{} job_id: {} uuid: {}".format(msf_module.NAME, result.get("job_id"), result.get("uuid")))
-            # 放入请求队列
-            req = {
-                'broker': msf_module.MODULE_BROKER,
-                'uuid': result.get("uuid"),
-                'module': msf_module,
-                'time': int(time.time()),
-                'job_id': result.get("job_id"),
-            }
-            Xcache.create_module_task(req)
+            # 放入任务注册表
+            ModuleTask.create(module_intent=msf_module, task_uuid=result.get("uuid"), job_id=result.get("job_id"))
             Notice.send_info("模块: {} {} 开始执行".format(msf_module.NAME, msf_module.target_str))
             return True
 
@@ -90,15 +82,15 @@ class MSFModule(object):
 
         # 获取对应模块实例
         try:
-            req = Xcache.get_module_task_by_uuid(task_uuid=msf_module_return_dict.get("uuid"))
+            req = ModuleTask.get(task_uuid=msf_module_return_dict.get("uuid"), timeout=0)
         except Exception as E:
             logger.error(E)
             return False
 
         if req is None:
-            logger.error("未找到请求模块实例")
-            logger.error(msf_module_return_dict)
-            return False
+            # 回调早于任务创建到达,缓存后等待任务创建,不阻塞订阅线程
+            logger.warning(f"未找到请求模块实例,等待任务创建: {msf_module_return_dict.get('uuid')}")
+            return ModuleTask.defer(msf_module_return_dict.get("uuid"), MSFModule.store_result_from_sub, message)
 
         module_intent = req.get('module')
         if module_intent is None:
@@ -127,7 +119,7 @@ class MSFModule(object):
         except Exception as E:
             logger.error(E)
 
-        Xcache.del_module_task_by_uuid(task_uuid=msf_module_return_dict.get("uuid"))  # 清理缓存信息
+        ModuleTask.delete(task_uuid=msf_module_return_dict.get("uuid"))  # 清理缓存信息
         Notice.send_success("模块: {} {} 执行完成".format(module_intent.NAME, module_intent.target_str))
 
     @staticmethod
@@ -135,15 +127,14 @@ class MSFModule(object):
         body = message.get('data')
         try:
             msf_module_return_dict = json.loads(body)
-            req = Xcache.get_module_task_by_uuid(task_uuid=msf_module_return_dict.get("uuid"))
+            req = ModuleTask.get(task_uuid=msf_module_return_dict.get("uuid"), timeout=0)
         except Exception as E:
             logger.error(E)
             return False
 
         if req is None:
-            logger.error("未找到请求报文")
-            logger.error(msf_module_return_dict)
-            return False
+            logger.warning(f"未找到请求报文,等待任务创建: {msf_module_return_dict.get('uuid')}")
+            return ModuleTask.defer(msf_module_return_dict.get("uuid"), MSFModule.store_monitor_from_sub, message)
 
         try:
             module_intent = req.get('module')
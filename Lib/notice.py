@@ -64,10 +64,20 @@ class Notice(object):
         return notice
 
     @staticmethod
-    def list_notices():
-        notices = Xcache.get_notices()
+    def list_notices(start=0, count=None):
+        notices = Xcache.get_notices(start=start, count=count)
         return notices
 
+    @staticmethod
+    def list_notices_after(last_id):
+        notices = Xcache.get_notices_after(last_id)
+        return notices
+
+    @staticmethod
+    def get_last_id():
+        last_id = Xcache.get_notices_last_id()
+        return last_id
+
     @staticmethod
     def clean_notices():
         flag = Xcache.clean_notices()
@@ -2,24 +2,323 @@
 # @File  : rpcclient.py
 # @Date  : 2021/2/26
 # @Desc  :
+import atexit
 import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import requests
+from requests.adapters import HTTPAdapter
 
 # 单例模式
 from CONFIG import RPC_TOKEN, JSON_RPC_URL
+from Lib.configs import MSFRPC_POOL_SIZE, MSFRPC_CONNECT_TIMEOUT, MSFRPC_MEMO_TTL, MSFRPC_BREAKER_FAILURES, \
+    MSFRPC_BREAKER_PROBE_INTERVAL, MSFRPC_METRICS_BUCKETS, MSFRPC_METRICS_FLUSH_INTERVAL
 from Lib.log import logger
+from Lib.method import Method
 from Lib.notice import Notice
+from Lib.xcache import Xcache
 
+# 显式指定连接池大小,调度线程,请求线程及websocket线程共用
 req_session = requests.session()
+req_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=MSFRPC_POOL_SIZE))
+req_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MSFRPC_POOL_SIZE))
+
+# 并发调用使用的线程池,大小与连接池一致
+rpc_executor = ThreadPoolExecutor(max_workers=MSFRPC_POOL_SIZE, thread_name_prefix="msfrpc")
+
+
+class RpcMetrics(object):
+    """msfrpc调用统计,按方法在进程内累加,由后台线程定期写入redis,所有进程共享
+    count为实际发送的请求数,memo_hit(复用结果)及breaker_open(熔断拒绝)不发送请求
+    latency_le_{N}为耗时在(上一分桶, N]毫秒内的次数
+    """
+    OK = "ok"
+    TIMEOUT = "timeout"
+    CONN_ERROR = "conn_error"
+    HTTP_ERROR = "http_error"
+    RPC_ERROR = "rpc_error"
+    MEMO_HIT = "memo_hit"
+    BREAKER_OPEN = "breaker_open"
+    BATCH = "batch"  # 批量请求整体的统计,其中每个调用另按各自的方法统计
+
+    _base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    # 进程内未写入redis的增量,{method: (counters, callers)}
+    _pending = {}
+    _lock = threading.Lock()
+    # 写入线程所在进程的pid,fork后的子进程需重新启动写入线程
+    _flush_pid = None
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def caller():
+        """rpcclient.py之外最近的调用位置,如 Msgrpc/Handle/job.py:90 list_msfrpc_jobs_no_cache"""
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_code.co_filename == __file__:
+            frame = frame.f_back
+        if frame is None:
+            return None
+        filename = frame.f_code.co_filename
+        if filename.startswith(RpcMetrics._base_dir):
+            filename = os.path.relpath(filename, RpcMetrics._base_dir)
+        else:
+            filename = os.path.basename(filename)
+        return f"{filename}:{frame.f_lineno} {frame.f_code.co_name}"
+
+    @staticmethod
+    def bucket(latency_ms):
+        for one in MSFRPC_METRICS_BUCKETS:
+            if latency_ms <= one:
+                return f"latency_le_{one}"
+        return "latency_le_inf"
+
+    @staticmethod
+    def record(method, outcome, latency=None, req_bytes=0, resp_bytes=0, extra=None):
+        """latency为请求耗时(秒),为None表示未发送请求"""
+        counters = {outcome: 1}
+        if latency is not None:
+            latency_ms = int(latency * 1000)
+            counters["count"] = 1
+            counters["latency_ms_sum"] = latency_ms
+            counters[RpcMetrics.bucket(latency_ms)] = 1
+            counters["req_bytes"] = req_bytes
+            counters["resp_bytes"] = resp_bytes
+        if extra is not None:
+            for key, value in extra.items():
+                counters[key] = counters.get(key, 0) + value
+        caller = RpcMetrics.caller()
+        with RpcMetrics._lock:
+            pending_counters, pending_callers = RpcMetrics._pending.setdefault(method, ({}, {}))
+            for key, value in counters.items():
+                pending_counters[key] = pending_counters.get(key, 0) + value
+            if caller is not None:
+                pending_callers[caller] = pending_callers.get(caller, 0) + 1
+            if RpcMetrics._flush_pid != os.getpid():
+                RpcMetrics._flush_pid = os.getpid()
+                threading.Thread(target=RpcMetrics._flush_loop, name="msfrpc_metrics", daemon=True).start()
+
+    @staticmethod
+    def flush():
+        """将进程内累加的统计一次写入redis"""
+        with RpcMetrics._lock:
+            pending = RpcMetrics._pending
+            RpcMetrics._pending = {}
+        Xcache.add_msfrpc_metrics(pending)
+
+    @staticmethod
+    def _flush_loop():
+        while True:
+            time.sleep(MSFRPC_METRICS_FLUSH_INTERVAL)
+            try:
+                RpcMetrics.flush()
+            except Exception as E:
+                logger.warning(E)
+
+    @staticmethod
+    def summary(counters):
+        """计数汇总为调用次数,错误数,平均及分位耗时(按分桶上限估算)"""
+        count = counters.get("count", 0)
+        errors = sum(counters.get(one, 0) for one in
+                     [RpcMetrics.TIMEOUT, RpcMetrics.CONN_ERROR, RpcMetrics.HTTP_ERROR, RpcMetrics.RPC_ERROR])
+        result = {"count": count,
+                  "errors": errors,
+                  "timeout": counters.get(RpcMetrics.TIMEOUT, 0),
+                  "memo_hit": counters.get(RpcMetrics.MEMO_HIT, 0),
+                  "breaker_open": counters.get(RpcMetrics.BREAKER_OPEN, 0),
+                  "avg_ms": None, "p50_ms": None, "p95_ms": None, "p99_ms": None}
+        if count == 0:
+            return result
+        result["avg_ms"] = round(counters.get("latency_ms_sum", 0) / count, 1)
+        buckets = MSFRPC_METRICS_BUCKETS + ["inf"]
+        for name, percent in [("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)]:
+            accumulated = 0
+            for one in buckets:
+                accumulated += counters.get(f"latency_le_{one}", 0)
+                if accumulated >= count * percent:
+                    result[name] = one
+                    break
+        return result
+
+
+atexit.register(RpcMetrics.flush)
+
+
+class RpcBreaker(object):
+    """msfrpc熔断器,进程内共享
+    closed    正常调用,连接失败(含连接超时)或5xx计为一次失败,连续MSFRPC_BREAKER_FAILURES次后进入open
+              读取超时说明服务端可连接,只计入调用统计
+    open      调用立即失败,MSFRPC_BREAKER_PROBE_INTERVAL秒后进入half_open
+    half_open 只放行一次探测调用,成功后恢复closed,失败则重新open
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    _state = CLOSED
+    _failures = 0
+    _opened_at = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def allow():
+        """是否允许本次调用"""
+        with RpcBreaker._lock:
+            if RpcBreaker._state == RpcBreaker.CLOSED:
+                return True
+            if RpcBreaker._state == RpcBreaker.OPEN and \
+                    time.time() - RpcBreaker._opened_at >= MSFRPC_BREAKER_PROBE_INTERVAL:
+                RpcBreaker._state = RpcBreaker.HALF_OPEN
+                return True
+            return False
+
+    @staticmethod
+    def record_success():
+        with RpcBreaker._lock:
+            if RpcBreaker._state != RpcBreaker.CLOSED:
+                logger.info("msfrpc恢复连接,熔断关闭")
+            RpcBreaker._state = RpcBreaker.CLOSED
+            RpcBreaker._failures = 0
+            RpcBreaker._opened_at = None
+
+    @staticmethod
+    def record_failure():
+        with RpcBreaker._lock:
+            RpcBreaker._failures += 1
+            if RpcBreaker._state == RpcBreaker.HALF_OPEN or RpcBreaker._failures >= MSFRPC_BREAKER_FAILURES:
+                if RpcBreaker._state == RpcBreaker.CLOSED:
+                    logger.warning(f"msfrpc连续{RpcBreaker._failures}次调用失败,熔断开启")
+                RpcBreaker._state = RpcBreaker.OPEN
+                RpcBreaker._opened_at = time.time()
+
+    @staticmethod
+    def record_reachable():
+        """已建立连接但读取超时,不计为失败;half_open的探测调用视为成功,避免一直停留在half_open"""
+        with RpcBreaker._lock:
+            half_open = RpcBreaker._state == RpcBreaker.HALF_OPEN
+        if half_open:
+            RpcBreaker.record_success()
+
+    @staticmethod
+    def status():
+        with RpcBreaker._lock:
+            return {"state": RpcBreaker._state,
+                    "failures": RpcBreaker._failures,
+                    "opened_at": None if RpcBreaker._opened_at is None else int(RpcBreaker._opened_at)}
 
 
 class RpcClient(object):
+    _batch_supported = True  # 服务端拒绝批量请求后置为False
+    JSONRPC_INVALID_REQUEST = -32600
+
+    # 可合并及短时复用结果的只读方法
+    MEMO_METHODS = [Method.JobList, Method.SessionList]
+    # 写方法调用后需失效的只读方法
+    INVALIDATE_METHODS = {
+        Method.ModuleExecute: [Method.JobList, Method.SessionList],
+        Method.JobStop: [Method.JobList],
+        Method.SessionStop: [Method.SessionList],
+        Method.SessionMeterpreterSessionKill: [Method.SessionList],
+        Method.ConsoleSessionKill: [Method.SessionList],
+    }
+
+    # 进程内共享,{key: (expire_time, 编码后的result)},{key: [Event, 编码后的result]},{method: generation}
+    # 结果以JSON文本保存,每个调用方得到独立的对象,可以直接修改
+    _memo = {}
+    _inflight = {}
+    _generations = {}
+    _memo_lock = threading.Lock()
+
     def __init__(self):
         pass
 
+    @staticmethod
+    def _memo_key(method, params):
+        return method, json.dumps(params, sort_keys=True)
+
+    @staticmethod
+    def _memo_get(key):
+        """返回(是否命中, 编码后的结果)"""
+        one = RpcClient._memo.get(key)
+        if one is not None and one[0] > time.time():
+            return True, one[1]
+        return False, None
+
+    @staticmethod
+    def _memo_set(key, generation, encoded):
+        """调用期间方法已被失效时不保存结果,失败的结果不保存"""
+        if encoded is None:
+            return
+        with RpcClient._memo_lock:
+            if RpcClient._generations.get(key[0], 0) == generation:
+                RpcClient._memo[key] = (time.time() + MSFRPC_MEMO_TTL, encoded)
+
+    @staticmethod
+    def invalidate(methods):
+        with RpcClient._memo_lock:
+            for method in methods:
+                RpcClient._generations[method] = RpcClient._generations.get(method, 0) + 1
+                for key in [key for key in RpcClient._memo if key[0] == method]:
+                    RpcClient._memo.pop(key)
+
     @staticmethod
     def call(method=None, params=None, timeout=11):
+        """只读方法在MSFRPC_MEMO_TTL秒内复用结果,相同的并发调用只发送一次请求"""
+        if method in RpcClient.INVALIDATE_METHODS:
+            # 写方法前后均失效,避免执行期间发起的读取保存旧结果
+            RpcClient.invalidate(RpcClient.INVALIDATE_METHODS.get(method))
+            result = RpcClient._call(method, params, timeout)
+            RpcClient.invalidate(RpcClient.INVALIDATE_METHODS.get(method))
+            return result
+        if method not in RpcClient.MEMO_METHODS or MSFRPC_MEMO_TTL <= 0:
+            return RpcClient._call(method, params, timeout)
+
+        key = RpcClient._memo_key(method, params)
+        owner = False
+        with RpcClient._memo_lock:
+            hit, encoded = RpcClient._memo_get(key)
+            if not hit:
+                flight = RpcClient._inflight.get(key)
+                if flight is None:
+                    # 本线程负责发送请求,flight为[Event, result]
+                    flight = [threading.Event(), None]
+                    RpcClient._inflight[key] = flight
+                    generation = RpcClient._generations.get(method, 0)
+                    owner = True
+        # 统计在锁外记录
+        if hit:
+            RpcMetrics.record(method, RpcMetrics.MEMO_HIT)
+            return json.loads(encoded)
+
+        if not owner:
+            # 等待进行中的相同调用,使用其结果的独立副本
+            if not flight[0].wait(timeout):
+                logger.warning(f"msfrpc调用超时: {method}")
+                return None
+            RpcMetrics.record(method, RpcMetrics.MEMO_HIT)
+            return None if flight[1] is None else json.loads(flight[1])
+
+        try:
+            result = RpcClient._call(method, params, timeout)
+            encoded = None if result is None else json.dumps(result)
+            flight[1] = encoded
+            RpcClient._memo_set(key, generation, encoded)
+        finally:
+            with RpcClient._memo_lock:
+                RpcClient._inflight.pop(key, None)
+            flight[0].set()
+        return result
+
+    @staticmethod
+    def _call(method=None, params=None, timeout=11):
         _headers = {
             'Connection': 'keep-alive',
             'Content-Type': 'application/json',
@@ -35,21 +334,205 @@ class RpcClient(object):
                 logger.warning("params 必须是list类型")
                 return None
         json_data = json.dumps(data)
+        if not RpcBreaker.allow():
+            RpcMetrics.record(method, RpcMetrics.BREAKER_OPEN)
+            return None
+        start = time.time()
         try:
-            r = req_session.post(JSON_RPC_URL, headers=_headers, data=json_data, timeout=(1.05, timeout))
-        except Exception as _:
+            r = req_session.post(JSON_RPC_URL, headers=_headers, data=json_data,
+                                 timeout=(MSFRPC_CONNECT_TIMEOUT, timeout))
+        except Exception as E:
+            if isinstance(E, requests.exceptions.ConnectionError):
+                # ConnectTimeout同为ConnectionError
+                RpcBreaker.record_failure()
+            else:
+                RpcBreaker.record_reachable()
+            outcome = RpcMetrics.TIMEOUT if isinstance(E, requests.exceptions.Timeout) else RpcMetrics.CONN_ERROR
+            RpcMetrics.record(method, outcome, time.time() - start, len(json_data))
             logger.warning('msf连接失败,检查 {} 是否可用'.format(JSON_RPC_URL))
             return None
+        latency = time.time() - start
+        if r.status_code >= 500:
+            RpcBreaker.record_failure()
+        else:
+            RpcBreaker.record_success()
         if r.status_code == 200:
             content = json.loads(r.content.decode('utf-8', 'ignore'))
             if content.get('error') is not None:
+                RpcMetrics.record(method, RpcMetrics.RPC_ERROR, latency, len(json_data), len(r.content))
                 logger.warning(
                     "错误码:{} 信息:{}".format(content.get('error').get('code'), content.get('error').get('message')))
                 Notice.send_exception(f"MSFRPC> {content.get('error').get('message')}")
                 return None
             else:
+                RpcMetrics.record(method, RpcMetrics.OK, latency, len(json_data), len(r.content))
                 return content.get('result')
 
         else:
+            RpcMetrics.record(method, RpcMetrics.HTTP_ERROR, latency, len(json_data), len(r.content))
             logger.warning("返回码:{} 结果:{}".format(r.status_code, r.content))
             return None
+
+    @staticmethod
+    def call_batch(calls, timeout=11):
+        """JSON-RPC 2.0 批量调用,calls为[(method, params), ...],一次请求发送
+        按顺序返回结果,单个调用出错时对应结果为None,不影响其他调用
+        服务端不支持批量请求时自动改为逐个调用
+        只读方法同样复用MSFRPC_MEMO_TTL秒内的结果,仅发送未命中的调用
+        """
+        if len(calls) == 0:
+            return []
+        results = [None] * len(calls)
+        pending = []
+        generations = {}
+        invalidate_methods = set()
+        for method, params in calls:
+            invalidate_methods.update(RpcClient.INVALIDATE_METHODS.get(method, []))
+        RpcClient.invalidate(invalidate_methods)
+        for i, (method, params) in enumerate(calls):
+            if method in RpcClient.MEMO_METHODS and MSFRPC_MEMO_TTL > 0:
+                with RpcClient._memo_lock:
+                    hit, encoded = RpcClient._memo_get(RpcClient._memo_key(method, params))
+                    generations[i] = RpcClient._generations.get(method, 0)
+                if hit:
+                    RpcMetrics.record(method, RpcMetrics.MEMO_HIT)
+                    results[i] = json.loads(encoded)
+                    continue
+            pending.append(i)
+        if len(pending) == 0:
+            return results
+
+        for i, result in zip(pending, RpcClient._call_batch([calls[i] for i in pending], timeout)):
+            results[i] = result
+            if i in generations:
+                method, params = calls[i]
+                encoded = None if result is None else json.dumps(result)
+                RpcClient._memo_set(RpcClient._memo_key(method, params), generations[i], encoded)
+        RpcClient.invalidate(invalidate_methods)
+        return results
+
+    @staticmethod
+    def _call_batch(calls, timeout=11):
+        if not RpcClient._batch_supported:
+            return RpcClient.gather(calls, timeout)
+
+        _headers = {
+            'Connection': 'keep-alive',
+            'Content-Type': 'application/json',
+            'Authorization': "Bearer {}".format(RPC_TOKEN),
+        }
+        data = []
+        for i, (method, params) in enumerate(calls):
+            one = {'jsonrpc': '2.0', 'id': i + 1, 'method': method}
+            if params is not None:
+                if isinstance(params, list):
+                    one['params'] = params
+                else:
+                    logger.warning("params 必须是list类型")
+                    return [None] * len(calls)
+            data.append(one)
+        json_data = json.dumps(data)
+        if not RpcBreaker.allow():
+            RpcClient._record_batch(calls, RpcMetrics.BREAKER_OPEN)
+            return [None] * len(calls)
+        start = time.time()
+        try:
+            r = req_session.post(JSON_RPC_URL, headers=_headers, data=json_data,
+                                 timeout=(MSFRPC_CONNECT_TIMEOUT, timeout))
+        except Exception as E:
+            if isinstance(E, requests.exceptions.ConnectionError):
+                # ConnectTimeout同为ConnectionError
+                RpcBreaker.record_failure()
+            else:
+                RpcBreaker.record_reachable()
+            outcome = RpcMetrics.TIMEOUT if isinstance(E, requests.exceptions.Timeout) else RpcMetrics.CONN_ERROR
+            RpcClient._record_batch(calls, outcome, time.time() - start, len(json_data))
+            logger.warning('msf连接失败,检查 {} 是否可用'.format(JSON_RPC_URL))
+            return [None] * len(calls)
+        latency = time.time() - start
+        if r.status_code >= 500:
+            RpcBreaker.record_failure()
+        else:
+            RpcBreaker.record_success()
+
+        content = None
+        try:
+            content = json.loads(r.content.decode('utf-8', 'ignore'))
+        except Exception as _:
+            pass
+        if r.status_code == 200 and isinstance(content, list):
+            pass
+        elif RpcClient._batch_rejected(content):
+            # 服务端明确返回不支持批量请求(Invalid Request),之后均逐个调用
+            RpcMetrics.record(RpcMetrics.BATCH, RpcMetrics.RPC_ERROR, latency, len(json_data), len(r.content))
+            logger.warning("msfrpc不支持批量请求,改为逐个调用")
+            RpcClient._batch_supported = False
+            return RpcClient.gather(calls, timeout)
+        else:
+            # 认证失败,服务端临时异常等,本次改为逐个调用,不影响之后的批量请求
+            RpcMetrics.record(RpcMetrics.BATCH, RpcMetrics.HTTP_ERROR, latency, len(json_data), len(r.content))
+            logger.warning("返回码:{} 结果:{}".format(r.status_code, r.content))
+            return RpcClient.gather(calls, timeout)
+
+        results = [None] * len(calls)
+        outcomes = [RpcMetrics.RPC_ERROR] * len(calls)  # 没有对应响应的调用计为rpc_error
+        for one in content:
+            if not isinstance(one, dict):
+                continue
+            index = one.get('id')
+            if not isinstance(index, int) or index < 1 or index > len(calls):
+                continue
+            if one.get('error') is not None:
+                logger.warning(
+                    "错误码:{} 信息:{}".format(one.get('error').get('code'), one.get('error').get('message')))
+                Notice.send_exception(f"MSFRPC> {one.get('error').get('message')}")
+                continue
+            outcomes[index - 1] = RpcMetrics.OK
+            results[index - 1] = one.get('result')
+        RpcClient._record_batch(calls, outcomes, latency, len(json_data), len(r.content))
+        return results
+
+    @staticmethod
+    def _record_batch(calls, outcomes, latency=None, req_bytes=0, resp_bytes=0):
+        """每个调用按各自的方法计入统计,耗时为整个批量请求的耗时,请求及响应大小只计入batch
+        批量请求整体计入batch,其中出错的调用数计入rpc_error
+        """
+        if not isinstance(outcomes, list):
+            outcomes = [outcomes] * len(calls)
+        for (method, params), outcome in zip(calls, outcomes):
+            RpcMetrics.record(method, outcome, latency)
+        if outcomes[0] in [RpcMetrics.OK, RpcMetrics.RPC_ERROR]:
+            # 收到批量响应
+            RpcMetrics.record(RpcMetrics.BATCH, RpcMetrics.OK, latency, req_bytes, resp_bytes,
+                              extra={RpcMetrics.RPC_ERROR: outcomes.count(RpcMetrics.RPC_ERROR)})
+        else:
+            RpcMetrics.record(RpcMetrics.BATCH, outcomes[0], latency, req_bytes, resp_bytes)
+
+    @staticmethod
+    def _batch_rejected(content):
+        """响应是否为单个Invalid Request错误(JSON-RPC服务端不支持批量请求时的返回)"""
+        if not isinstance(content, dict) or not isinstance(content.get('error'), dict):
+            return False
+        return content.get('error').get('code') == RpcClient.JSONRPC_INVALID_REQUEST
+
+    @staticmethod
+    def gather(calls, timeout=11):
+        """并发执行多个相互独立的调用,calls为[(method, params), ...]
+        按顺序返回结果,失败或超过timeout秒未返回的调用结果为None
+        服务端不支持或本次未能处理批量请求时,call_batch改为由此逐个调用
+        """
+        if len(calls) == 1:
+            method, params = calls[0]
+            return [RpcClient.call(method, params, timeout)]
+        futures = [rpc_executor.submit(RpcClient.call, method, params, timeout) for method, params in calls]
+        wait(futures, timeout=timeout)
+        results = []
+        for (method, params), future in zip(calls, futures):
+            if future.done() and future.exception() is None:
+                results.append(future.result())
+            else:
+                if not future.done():
+                    logger.warning(f"msfrpc调用超时: {method}")
+                results.append(None)
+        return results
+
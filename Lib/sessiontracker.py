@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# @File  : sessiontracker.py
+# @Date  : 2021/3/6
+# @Desc  :
+import hashlib
+import json
+import threading
+import time
+
+from Lib.configs import SESSION_CHECKIN_STALE
+from Lib.log import logger
+from Lib.notice import Notice
+from Lib.xcache import Xcache
+
+
+class SessionTracker(object):
+    """比较相邻两次SessionList的结果,生成session生命周期事件
+
+    事件类型:
+    opened        新出现的session
+    closed        消失的session
+    checkin_stale 超过SESSION_CHECKIN_STALE秒未回连(恢复回连后可再次触发)
+    info_updated  除last_checkin外的信息发生变化(如初始化完成,路由变化)
+    """
+    OPENED = "opened"
+    CLOSED = "closed"
+    CHECKIN_STALE = "checkin_stale"
+    INFO_UPDATED = "info_updated"
+
+    # 仅在监控进程内维护,{sid: {"fingerprint", "session_host", "available", "stale"}}
+    _sessions = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def fingerprint(info):
+        """session原始信息的指纹,不包含每次回连都会变化的last_checkin"""
+        data = {key: value for key, value in info.items() if key != "last_checkin"}
+        return hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_available(info):
+        return len(str(info.get('info')).split(' @ ')) > 1
+
+    @staticmethod
+    def update(infos, fingerprints=None):
+        """infos为SessionList的原始结果,fingerprints为调用方已计算的指纹,返回本次生成的事件列表并写入事件流"""
+        if fingerprints is None:
+            fingerprints = {key: SessionTracker.fingerprint(info) for key, info in infos.items()
+                            if isinstance(info, dict)}
+        now = int(time.time())
+        events = []
+        with SessionTracker._lock:
+            first_update = SessionTracker._sessions is None
+            old_sessions = SessionTracker._sessions or {}
+            new_sessions = {}
+            for key, info in infos.items():
+                if not isinstance(info, dict):
+                    continue
+                try:
+                    sid = int(key)
+                except Exception as _:
+                    continue
+                state = {"fingerprint": fingerprints.get(key),
+                         "session_host": info.get('session_host'),
+                         "available": SessionTracker.is_available(info),
+                         "stale": False}
+                last_checkin = info.get('last_checkin')
+                if isinstance(last_checkin, int) and now - last_checkin > SESSION_CHECKIN_STALE:
+                    state["stale"] = True
+                new_sessions[sid] = state
+
+                event = {"sid": sid, "session_host": state["session_host"], "available": state["available"],
+                         "time": now}
+                old_state = old_sessions.get(sid)
+                if old_state is None:
+                    events.append(dict(event, type=SessionTracker.OPENED))
+                    continue
+                if old_state["fingerprint"] != state["fingerprint"]:
+                    events.append(dict(event, type=SessionTracker.INFO_UPDATED,
+                                       became_available=state["available"] and not old_state["available"]))
+                if state["stale"] and not old_state["stale"]:
+                    events.append(dict(event, type=SessionTracker.CHECKIN_STALE, last_checkin=last_checkin))
+
+            for sid, old_state in old_sessions.items():
+                if sid not in new_sessions:
+                    events.append({"type": SessionTracker.CLOSED, "sid": sid,
+                                   "session_host": old_state["session_host"],
+                                   "available": old_state["available"],
+                                   "time": now})
+            SessionTracker._sessions = new_sessions
+
+        # 监控进程重启后第一次获取的session不视为新上线
+        if first_update:
+            for event in events:
+                event["initial"] = True
+        Xcache.add_session_events(events)
+        return events
+
+    @staticmethod
+    def notify_from_sub(message):
+        """session监控:新session上线(或初始化完成)时发送通知"""
+        try:
+            event = json.loads(message.get('data'))
+        except Exception as E:
+            logger.exception(E)
+            return
+        if event.get("initial"):
+            return
+        if not Xcache.get_sessionmonitor_conf().get("flag"):
+            return
+        if event.get("type") == SessionTracker.OPENED and event.get("available") or \
+                event.get("type") == SessionTracker.INFO_UPDATED and event.get("became_available"):
+            Notice.send_sms(f"新增Session: {event.get('sid')} IP: {event.get('session_host')}")
+            Notice.send_info(f"新增Session: {event.get('sid')} IP: {event.get('session_host')}")
@@ -3,19 +3,32 @@
 # @Date  : 2021/2/25
 # @Desc  :
 import copy
+import json
+import os
+import pickle
+import threading
 import time
 import uuid
+from collections import OrderedDict
 
 from django.core.cache import cache
+from django_redis import get_redis_connection
 
+from Lib.configs import MODULE_RESULT_HISTORY_MAXLEN, NOTICES_MAXLEN, SESSIONIO_CACHE_MAXBYTES, SESSION_EVENTS_MAXLEN
+from Lib.configs import VIPER_SESSION_EVENT_CHANNEL, HEARTBEAT_SUBSCRIBER_TTL
+from Lib.configs import VIPER_DATA_VERSION_CHANNEL, VIPER_MODULE_TASK_CHANNEL, XCACHE_LOCAL_INVALIDATE_CHANNEL, LOCAL_CACHE_TTL, LOCAL_CACHE_MAXSIZE
 from Lib.log import logger
+from Lib.redisclient import RedisClient
 
 
 class Xcache(object):
     """缓存模块"""
     XCACHE_MODULES_CONFIG = "XCACHE_MODULES_CONFIG"
+    XCACHE_MODULES_CONFIG_HASH = "XCACHE_MODULES_CONFIG_HASH"
 
     XCACHE_SESSION_INFO = "XCACHE_SESSION_INFO"
+    XCACHE_SESSION_INFO_INDEX = "XCACHE_SESSION_INFO_INDEX"
+    XCACHE_SESSION_EVENTS = "XCACHE_SESSION_EVENTS"
 
     XCACHE_HADLER_VIRTUAL_LIST = "XCACHE_HADLER_VIRTUAL_LIST"
 
@@ -24,16 +37,42 @@ class Xcache(object):
     XCACHE_NOTICES_LIST = "XCACHE_NOTICES_LIST"
 
     XCACHE_MODULES_TASK_LIST = "XCACHE_MODULES_TASK_LIST"
+    XCACHE_MODULES_TASK_INDEX = "XCACHE_MODULES_TASK_INDEX"
+    XCACHE_MODULES_TASK_INSTANCE = "XCACHE_MODULES_TASK_INSTANCE"
 
     XCACHE_BOT_MODULES_WAIT_LIST = "XCACHE_BOT_MODULES_WAIT_LIST"
+    XCACHE_BOT_MODULES_WAIT_INDEX = "XCACHE_BOT_MODULES_WAIT_INDEX"
 
     XCACHE_MODULES_RESULT = "XCACHE_MODULES_RESULT"
+    XCACHE_MODULES_RESULT_INDEX = "XCACHE_MODULES_RESULT_INDEX"
+    XCACHE_MODULES_RESULT_UPDATE_TIME = "XCACHE_MODULES_RESULT_UPDATE_TIME"
     XCACHE_MODULES_RESULT_HISTORY = "XCACHE_MODULES_RESULT_HISTORY"
-    XCACHE_HEARTBEAT_CACHE_RESULT_HISTORY = "XCACHE_HEARTBEAT_CACHE_RESULT_HISTORY"
-    XCACHE_HEARTBEAT_CACHE_NOTICES = "XCACHE_HEARTBEAT_CACHE_NOTICES"
-    XCACHE_HEARTBEAT_CACHE_JOBS = "XCACHE_HEARTBEAT_CACHE_JOBS"
-    XCACHE_HEARTBEAT_CACHE_BOT_WAIT_LIST = "XCACHE_HEARTBEAT_CACHE_BOT_WAIT_LIST"
-    XCACHE_HEARTBEAT_CACHE_HOSTS_SORTED = "XCACHE_HEARTBEAT_CACHE_HOSTS_SORTED"
+    XCACHE_MODULES_RESULT_HISTORY_HOSTS = "XCACHE_MODULES_RESULT_HISTORY_HOSTS"
+    # 每个主机一个有序集合,成员为entry_id,score为entry_id的毫秒时间戳,用于清理已被裁剪的记录
+    XCACHE_MODULES_RESULT_HISTORY_HOST_INDEX = "XCACHE_MODULES_RESULT_HISTORY_HOST_INDEX"
+    XCACHE_MODULES_RESULT_HISTORY_PRUNE_COUNTER = "XCACHE_MODULES_RESULT_HISTORY_PRUNE_COUNTER"
+    RESULT_HISTORY_PRUNE_EVERY = 100  # stream已满时每新增该数量的记录清理一次主机索引
+    XCACHE_HEARTBEAT_CACHE_NOTICES_LAST_ID = "XCACHE_HEARTBEAT_CACHE_NOTICES_LAST_ID"
+    XCACHE_HEARTBEAT_SUBSCRIBERS = "XCACHE_HEARTBEAT_SUBSCRIBERS"
+    # 心跳快照(hash),每个部分一个字段保存已编码的JSON,另有seq/notices_last_id/time字段
+    XCACHE_HEARTBEAT_SNAPSHOT = "XCACHE_HEARTBEAT_SNAPSHOT"
+
+    # msfrpc调用统计,每个方法一个计数hash及一个调用位置hash,方法名集合作为索引
+    XCACHE_MSFRPC_METRICS = "XCACHE_MSFRPC_METRICS"
+    XCACHE_MSFRPC_METRICS_CALLERS = "XCACHE_MSFRPC_METRICS_CALLERS"
+    XCACHE_MSFRPC_METRICS_INDEX = "XCACHE_MSFRPC_METRICS_INDEX"
+
+    # 旧版本通过KEYS扫描读取各类缓存,升级后首次启动时为已有数据补建索引,完成后写入该标记
+    XCACHE_INDEX_BACKFILLED = "XCACHE_INDEX_BACKFILLED"
+
+    # 各类数据的版本号(hash),写入方递增对应字段,心跳据此判断是否需要重新计算
+    XCACHE_DATA_VERSION = "XCACHE_DATA_VERSION"
+    DATA_VERSION_MODULE_TASK = "module_task"
+    DATA_VERSION_BOT_WAIT = "bot_wait"
+    DATA_VERSION_RESULT_HISTORY = "result_history"
+    DATA_VERSION_NOTICES = "notices"
+    DATA_VERSION_NOTICES_CLEAN = "notices_clean"  # 清空通知时递增,心跳据此通知客户端清空列表
+    DATA_VERSION_HOSTS = "hosts"
 
     XCACHE_MSFCONSOLE_INPUT_CACHE = "XCACHE_MSFCONSOLE_INPUT_CACHE"
     XCACHE_MSFCONSOLE_CID = "XCACHE_MSFCONSOLE_CID"
@@ -49,7 +88,6 @@ class Xcache(object):
     XCACHE_FOFA_CONFIG = "XCACHE_FOFA_CONFIG"
 
     XCACHE_SESSIONMONITOR_CONFIG = "XCACHE_SESSIONMONITOR_CONFIG"
-    XCACHE_SESSION_CONT = "XCACHE_SESSION_CONT"
 
     XCACHE_AES_KEY = "XCACHE_AES_KEY"
 
@@ -63,87 +101,358 @@ class Xcache(object):
     XCACHE_SESSIONIO_CACHE = "XCACHE_SESSIONIO_CACHE"
 
     XCACHE_LAZYLOADER_CACHE = "XCACHE_LAZYLOADER_CACHE"
+    XCACHE_LAZYLOADER_INDEX = "XCACHE_LAZYLOADER_INDEX"
+
+    # 追加后返回尾部数据,超出两倍容量时才截断,避免每次追加都重写整个缓冲区
+    _SESSIONIO_APPEND_SCRIPT = """
+    local length = redis.call('APPEND', KEYS[1], ARGV[1])
+    local maxbytes = tonumber(ARGV[2])
+    local tail = redis.call('GETRANGE', KEYS[1], -maxbytes, -1)
+    if length > maxbytes * 2 then
+        redis.call('SET', KEYS[1], tail)
+    end
+    return tail
+    """
+
+    # 进程内缓存,用于读多写少的配置类key,其他进程写入时通过redis订阅失效
+    _local_cache = OrderedDict()
+    _local_cache_lock = threading.Lock()
+    _local_cache_pid = None
+    _local_cache_generation = 0
 
     def __init__(self):
         pass
 
+    @staticmethod
+    def _redis():
+        """原生redis连接,用于维护集合索引(与cache共用连接池)"""
+        return get_redis_connection("default")
+
+    @staticmethod
+    def _local_cache_clear():
+        with Xcache._local_cache_lock:
+            Xcache._local_cache.clear()
+            Xcache._local_cache_generation += 1
+
+    @staticmethod
+    def _local_cache_listen():
+        """这个函数必须以线程的方式运行,监听失效通知并删除本地副本"""
+        while True:
+            rcon = RedisClient.get_result_connection()
+            if rcon is not None:
+                try:
+                    ps = rcon.pubsub(ignore_subscribe_messages=True)
+                    ps.subscribe(XCACHE_LOCAL_INVALIDATE_CHANNEL)
+                    Xcache._local_cache_clear()  # 订阅成功前可能错过了失效通知
+                    for message in ps.listen():
+                        key = message.get("data").decode('utf-8')
+                        with Xcache._local_cache_lock:
+                            Xcache._local_cache.pop(key, None)
+                            Xcache._local_cache_generation += 1
+                except Exception as E:
+                    logger.warning(E)
+            # 订阅断开期间无法保证一致性,清空本地缓存后重连
+            Xcache._local_cache_clear()
+            time.sleep(1)
+
+    @staticmethod
+    def _local_cache_start():
+        """每个进程(包括uwsgi fork出的worker)启动一个订阅线程"""
+        pid = os.getpid()
+        if Xcache._local_cache_pid == pid:
+            return
+        with Xcache._local_cache_lock:
+            if Xcache._local_cache_pid == pid:
+                return
+            Xcache._local_cache.clear()
+            Xcache._local_cache_pid = pid
+        threading.Thread(target=Xcache._local_cache_listen, name="XcacheInvalidate", daemon=True).start()
+
+    @staticmethod
+    def _local_get(key):
+        """本地缓存直接保存对象,命中时无需反序列化
+        返回浅拷贝,调用方可以增删修改顶层字段(如get_lhost_config),不能修改嵌套对象
+        """
+        Xcache._local_cache_start()
+        now = time.time()
+        with Xcache._local_cache_lock:
+            item = Xcache._local_cache.get(key)
+            if item is not None and item[0] > now:
+                Xcache._local_cache.move_to_end(key)
+                return copy.copy(item[1])
+            generation = Xcache._local_cache_generation
+
+        value = cache.get(key)
+        with Xcache._local_cache_lock:
+            # 读取期间收到失效通知时不写入本地缓存,避免保存旧数据
+            if generation == Xcache._local_cache_generation:
+                Xcache._local_cache[key] = (now + LOCAL_CACHE_TTL, value)
+                Xcache._local_cache.move_to_end(key)
+                while len(Xcache._local_cache) > LOCAL_CACHE_MAXSIZE:
+                    Xcache._local_cache.popitem(last=False)
+        return copy.copy(value)
+
+    @staticmethod
+    def _local_set(key, value, timeout=None):
+        cache.set(key, value, timeout)
+        with Xcache._local_cache_lock:
+            Xcache._local_cache.pop(key, None)
+            Xcache._local_cache_generation += 1
+        Xcache._redis().publish(XCACHE_LOCAL_INVALIDATE_CHANNEL, key)
+
+    @staticmethod
+    def _index_add(index, member):
+        Xcache._redis().sadd(index, member)
+
+    @staticmethod
+    def _index_remove(index, member):
+        Xcache._redis().srem(index, member)
+
+    @staticmethod
+    def _index_members(index):
+        return [member.decode('utf-8') for member in Xcache._redis().smembers(index)]
+
+    @staticmethod
+    def _list_by_index(index, prefix):
+        """SMEMBERS+MGET读取一类缓存,同时清理索引中已不存在的成员"""
+        members = Xcache._index_members(index)
+        if len(members) == 0:
+            return []
+        keys = ["{}_{}".format(prefix, member) for member in members]
+        datas = cache.get_many(keys)
+        reqs = []
+        stale_members = []
+        for member, key in zip(members, keys):
+            req = datas.get(key)
+            if req is None:
+                stale_members.append(member)
+            else:
+                reqs.append(req)
+        if len(stale_members) > 0:
+            Xcache._redis().srem(index, *stale_members)
+        return reqs
+
+    @staticmethod
+    def get_many(keys):
+        """MGET批量读取,返回{key: value},不存在的key不在结果中"""
+        if len(keys) == 0:
+            return {}
+        return cache.get_many(keys)
+
+    @staticmethod
+    def set_many(data, timeout=None):
+        """pipeline批量写入"""
+        if len(data) == 0:
+            return True
+        cache.set_many(data, timeout)
+        return True
+
+    @staticmethod
+    def delete_many(keys):
+        if len(keys) == 0:
+            return True
+        cache.delete_many(keys)
+        return True
+
     @staticmethod
     def init_xcache_on_start():
+        # 为旧版本写入的数据补建索引,需在下面按索引清理之前执行
+        Xcache._backfill_indexes()
+
         # 清理模块配置缓存
-        cache.set(Xcache.XCACHE_MODULES_CONFIG, None, None)
+        Xcache.clean_moduleconfigs()
 
         # 清理muit_module缓存
-        re_key = "{}_*".format(Xcache.XCACHE_MODULES_TASK_LIST)
-        keys = cache.keys(re_key)
-        for key in keys:
-            try:
-                req = cache.get(key)
-            except Exception as _:
-                cache.delete(key)
-                continue
-            if req.get("job_id") is None:
-                cache.delete(key)
+        task_uuids = Xcache._index_members(Xcache.XCACHE_MODULES_TASK_INDEX)
+        keys = ["{}_{}".format(Xcache.XCACHE_MODULES_TASK_LIST, task_uuid) for task_uuid in task_uuids]
+        try:
+            reqs = Xcache.get_many(keys)
+        except Exception as E:
+            logger.warning(E)
+            reqs = {}
+        del_task_uuids = []
+        for task_uuid, key in zip(task_uuids, keys):
+            req = reqs.get(key)
+            if req is None or req.get("job_id") is None:
+                del_task_uuids.append(task_uuid)
+        Xcache.del_module_tasks(del_task_uuids)
 
         # 清理session_info缓存
-        re_key = "{}_*".format(Xcache.XCACHE_SESSION_INFO)
-        keys = cache.keys(re_key)
-        for key in keys:
-            try:
-                cache.delete(key)
-            except Exception as _:
+        sessionids = Xcache._index_members(Xcache.XCACHE_SESSION_INFO_INDEX)
+        keys = ["{}_{}".format(Xcache.XCACHE_SESSION_INFO, sessionid) for sessionid in sessionids]
+        if len(keys) > 0:
+            cache.delete_many(keys)
+        Xcache._redis().delete(Xcache.XCACHE_SESSION_INFO_INDEX)
+
+        # 清理心跳订阅者(上次运行未正常断开的连接)及快照(序号重新开始)
+        Xcache._redis().delete(Xcache.XCACHE_HEARTBEAT_SUBSCRIBERS)
+        Xcache.del_heartbeat_snapshot()
+
+        # 历史结果的主机索引由集合改为有序集合,转换旧数据并清理已被裁剪的记录
+        Xcache._migrate_result_history_index()
+        Xcache.prune_module_result_history_index()
+        return True
+
+    @staticmethod
+    def _backfill_indexes():
+        """扫描旧版本写入的缓存key,补建对应的索引集合,只执行一次"""
+        redis_conn = Xcache._redis()
+        if redis_conn.exists(Xcache.XCACHE_INDEX_BACKFILLED):
+            return True
+        families = [(Xcache.XCACHE_MODULES_TASK_LIST, Xcache.XCACHE_MODULES_TASK_INDEX),
+                    (Xcache.XCACHE_BOT_MODULES_WAIT_LIST, Xcache.XCACHE_BOT_MODULES_WAIT_INDEX),
+                    (Xcache.XCACHE_SESSION_INFO, Xcache.XCACHE_SESSION_INFO_INDEX),
+                    (Xcache.XCACHE_LAZYLOADER_CACHE, Xcache.XCACHE_LAZYLOADER_INDEX)]
+        for prefix, index in families:
+            members = []
+            for key in cache.iter_keys("{}_*".format(prefix)):
+                members.append(key[len(prefix) + 1:])
+            if len(members) > 0:
+                redis_conn.sadd(index, *members)
+
+        # 旧版本的模块结果为{"update_time", "result"}字典,转换为APPEND使用的字符串及更新时间
+        prefix = Xcache.XCACHE_MODULES_RESULT
+        other_keys = (Xcache.XCACHE_MODULES_RESULT_INDEX, Xcache.XCACHE_MODULES_RESULT_UPDATE_TIME,
+                      Xcache.XCACHE_MODULES_RESULT_HISTORY)
+        for key in cache.iter_keys("{}_*".format(prefix)):
+            if key.startswith(other_keys):
                 continue
-        # 清理session_count 缓存
-        cache.set(Xcache.XCACHE_SESSION_CONT, 0, None)
+            ipaddress, _, loadpath = key[len(prefix) + 1:].partition("_")
+            if ipaddress == "" or loadpath == "":
+                continue
+            old_result = cache.get(key)
+            if isinstance(old_result, dict) and old_result.get("result") is not None:
+                result_key = "{}_{}_{}".format(prefix, ipaddress, loadpath)
+                pipe = redis_conn.pipeline(transaction=True)
+                pipe.set(result_key, old_result.get("result"))
+                pipe.hset(Xcache.XCACHE_MODULES_RESULT_UPDATE_TIME, result_key,
+                          int(old_result.get("update_time") or time.time()))
+                pipe.sadd("{}_{}".format(Xcache.XCACHE_MODULES_RESULT_INDEX, ipaddress), loadpath)
+                pipe.execute()
+                cache.delete(key)
+
+        Xcache._migrate_result_history_list()
+
+        # 旧版本的通知列表及sessionio缓存字典已由stream及每个主机独立的key替代
+        cache.delete_many([Xcache.XCACHE_NOTICES_LIST, Xcache.XCACHE_SESSIONIO_CACHE])
+
+        redis_conn.set(Xcache.XCACHE_INDEX_BACKFILLED, 1)
         return True
 
     @staticmethod
-    def get_heartbeat_cache_hosts_sorted():
-        result = cache.get(Xcache.XCACHE_HEARTBEAT_CACHE_HOSTS_SORTED)
-        return result
+    def _migrate_result_history_list():
+        """旧版本的历史结果为cache中的列表,按原顺序写入stream及主机索引后删除"""
+        old_history = cache.get(Xcache.XCACHE_MODULES_RESULT_HISTORY)
+        if not isinstance(old_history, list):
+            return True
+        old_history = old_history[-MODULE_RESULT_HISTORY_MAXLEN:]
+        if len(old_history) > 0:
+            redis_conn = Xcache._redis()
+            pipe = redis_conn.pipeline(transaction=False)
+            for one_result in old_history:
+                pipe.xadd(Xcache.XCACHE_MODULES_RESULT_HISTORY, {"data": pickle.dumps(one_result)},
+                          maxlen=MODULE_RESULT_HISTORY_MAXLEN, approximate=True)
+            entry_ids = pipe.execute()
+            pipe = redis_conn.pipeline(transaction=False)
+            for one_result, entry_id in zip(old_history, entry_ids):
+                ipaddress = one_result.get("ipaddress")
+                pipe.zadd("{}_{}".format(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOST_INDEX, ipaddress),
+                          {entry_id: Xcache._entry_id_score(entry_id)})
+                pipe.sadd(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOSTS, ipaddress)
+            Xcache.incr_data_version(Xcache.DATA_VERSION_RESULT_HISTORY, pipe)
+            pipe.execute()
+        cache.delete(Xcache.XCACHE_MODULES_RESULT_HISTORY)
+        return True
 
     @staticmethod
-    def set_heartbeat_cache_hosts_sorted(result):
-        cache.set(Xcache.XCACHE_HEARTBEAT_CACHE_HOSTS_SORTED, result, None)
+    def _migrate_result_history_index():
+        redis_conn = Xcache._redis()
+        for ipaddress in Xcache._index_members(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOSTS):
+            index = "{}_{}".format(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOST_INDEX, ipaddress)
+            if redis_conn.type(index) != b"set":
+                continue
+            entry_ids = redis_conn.smembers(index)
+            pipe = redis_conn.pipeline(transaction=True)
+            pipe.delete(index)
+            if len(entry_ids) > 0:
+                pipe.zadd(index, {entry_id: Xcache._entry_id_score(entry_id) for entry_id in entry_ids})
+            pipe.execute()
+
+    @staticmethod
+    def incr_data_version(family, pipe=None):
+        """递增数据版本号并发布变化事件,传入pipe时随pipeline一起执行"""
+        if pipe is None:
+            pipe = Xcache._redis().pipeline(transaction=False)
+            pipe.hincrby(Xcache.XCACHE_DATA_VERSION, family, 1)
+            pipe.publish(VIPER_DATA_VERSION_CHANNEL, family)
+            pipe.execute()
+            return True
+        pipe.hincrby(Xcache.XCACHE_DATA_VERSION, family, 1)
+        pipe.publish(VIPER_DATA_VERSION_CHANNEL, family)
         return True
 
     @staticmethod
-    def get_heartbeat_cache_result_history():
-        result = cache.get(Xcache.XCACHE_HEARTBEAT_CACHE_RESULT_HISTORY)
-        return result
+    def get_data_versions():
+        """一次读取全部数据版本号,{family: version}"""
+        versions = Xcache._redis().hgetall(Xcache.XCACHE_DATA_VERSION)
+        return {family.decode('utf-8'): int(version) for family, version in versions.items()}
 
     @staticmethod
-    def set_heartbeat_cache_result_history(result):
-        cache.set(Xcache.XCACHE_HEARTBEAT_CACHE_RESULT_HISTORY, result, None)
+    def add_heartbeat_subscriber(channel_name):
+        """登记或续期心跳客户端,有序集合的score为最近一次续期时间"""
+        Xcache._redis().zadd(Xcache.XCACHE_HEARTBEAT_SUBSCRIBERS, {channel_name: time.time()})
         return True
 
     @staticmethod
-    def get_heartbeat_cache_notices():
-        result = cache.get(Xcache.XCACHE_HEARTBEAT_CACHE_NOTICES)
-        return result
+    def del_heartbeat_subscriber(channel_name):
+        Xcache._redis().zrem(Xcache.XCACHE_HEARTBEAT_SUBSCRIBERS, channel_name)
+        return True
+
+    @staticmethod
+    def get_heartbeat_subscriber_count():
+        """先清理超过HEARTBEAT_SUBSCRIBER_TTL秒未续期的客户端(daphne崩溃或未收到disconnect)"""
+        pipe = Xcache._redis().pipeline(transaction=False)
+        pipe.zremrangebyscore(Xcache.XCACHE_HEARTBEAT_SUBSCRIBERS, "-inf", time.time() - HEARTBEAT_SUBSCRIBER_TTL)
+        pipe.zcard(Xcache.XCACHE_HEARTBEAT_SUBSCRIBERS)
+        return pipe.execute()[1]
 
     @staticmethod
-    def set_heartbeat_cache_notices(result):
-        cache.set(Xcache.XCACHE_HEARTBEAT_CACHE_NOTICES, result, None)
+    def set_heartbeat_snapshot(fields):
+        """fields为{字段: 已编码的JSON},只写入变化的部分,一次HSET原子写入"""
+        Xcache._redis().hset(Xcache.XCACHE_HEARTBEAT_SNAPSHOT, mapping=fields)
         return True
 
     @staticmethod
-    def get_heartbeat_cache_jobs():
-        result = cache.get(Xcache.XCACHE_HEARTBEAT_CACHE_JOBS)
-        return result
+    def set_heartbeat_snapshot_time(update_time):
+        """快照仅在数据变化时重写,每次心跳只刷新时间"""
+        Xcache._redis().hset(Xcache.XCACHE_HEARTBEAT_SNAPSHOT, "time", update_time)
+        return True
+
+    @staticmethod
+    def get_heartbeat_snapshot(max_age):
+        """读取不超过max_age秒的心跳快照字段{字段: 已编码的JSON},没有或过期时返回None"""
+        result = Xcache._redis().hgetall(Xcache.XCACHE_HEARTBEAT_SNAPSHOT)
+        fields = {key.decode('utf-8'): value.decode('utf-8') for key, value in result.items()}
+        update_time = fields.pop("time", None)
+        if update_time is None or "seq" not in fields:
+            return None
+        if time.time() - float(update_time) > max_age:
+            return None
+        return fields
 
     @staticmethod
-    def set_heartbeat_cache_jobs(result):
-        cache.set(Xcache.XCACHE_HEARTBEAT_CACHE_JOBS, result, None)
+    def del_heartbeat_snapshot():
+        Xcache._redis().delete(Xcache.XCACHE_HEARTBEAT_SNAPSHOT)
         return True
 
     @staticmethod
-    def get_heartbeat_cache_bot_wait_list():
-        result = cache.get(Xcache.XCACHE_HEARTBEAT_CACHE_BOT_WAIT_LIST)
+    def get_heartbeat_cache_notices_last_id():
+        result = cache.get(Xcache.XCACHE_HEARTBEAT_CACHE_NOTICES_LAST_ID)
         return result
 
     @staticmethod
-    def set_heartbeat_cache_bot_wait_list(result):
-        cache.set(Xcache.XCACHE_HEARTBEAT_CACHE_BOT_WAIT_LIST, result, None)
+    def set_heartbeat_cache_notices_last_id(last_id):
+        cache.set(Xcache.XCACHE_HEARTBEAT_CACHE_NOTICES_LAST_ID, last_id, None)
         return True
 
     @staticmethod
@@ -156,17 +465,6 @@ class Xcache(object):
         cache.set(Xcache.XCACHE_MSF_JOB_CACHE, msfjobs, None)
         return True
 
-    @staticmethod
-    def get_module_task_by_uuid(task_uuid):
-        for i in range(2):
-            key = "{}_{}".format(Xcache.XCACHE_MODULES_TASK_LIST, task_uuid)
-            req = cache.get(key)
-            if req is not None:
-                return req
-            else:
-                pass
-            time.sleep(1)
-
     @staticmethod
     def get_module_task_by_uuid_nowait(task_uuid):
         key = "{}_{}".format(Xcache.XCACHE_MODULES_TASK_LIST, task_uuid)
@@ -175,16 +473,21 @@ class Xcache(object):
 
     @staticmethod
     def list_module_tasks():
-        re_key = "{}_*".format(Xcache.XCACHE_MODULES_TASK_LIST)
-        keys = cache.keys(re_key)
-        reqs = []
-        for key in keys:
-            reqs.append(cache.get(key))
+        reqs = Xcache._list_by_index(Xcache.XCACHE_MODULES_TASK_INDEX, Xcache.XCACHE_MODULES_TASK_LIST)
         return reqs
 
     @staticmethod
-    def create_module_task(req):
-        """任务队列"""
+    def get_module_task_instance(task_uuid):
+        key = "{}_{}".format(Xcache.XCACHE_MODULES_TASK_INSTANCE, task_uuid)
+        module_intent = cache.get(key)
+        return module_intent
+
+    @staticmethod
+    def create_module_task(req, module_intent=None):
+        """任务队列,req为任务描述,模块实例单独存储,仅在其他进程处理回调时读取"""
+        if module_intent is not None:
+            key = "{}_{}".format(Xcache.XCACHE_MODULES_TASK_INSTANCE, req.get("uuid"))
+            cache.set(key, module_intent, None)
         for i in range(5):
             key = "{}_{}".format(Xcache.XCACHE_MODULES_TASK_LIST, req.get("uuid"))
             cache.set(key, req, None)
@@ -193,35 +496,56 @@ class Xcache(object):
             else:
                 logger.error("redis 缓存失败!")
             time.sleep(0.5)
+        Xcache._index_add(Xcache.XCACHE_MODULES_TASK_INDEX, req.get("uuid"))
+        Xcache.incr_data_version(Xcache.DATA_VERSION_MODULE_TASK)
+        # 通知其他进程任务已创建
+        Xcache._redis().publish(VIPER_MODULE_TASK_CHANNEL, req.get("uuid"))
+        return True
+
+    @staticmethod
+    def del_module_tasks(task_uuids):
+        if len(task_uuids) == 0:
+            return True
+        keys = []
+        for task_uuid in task_uuids:
+            keys.append("{}_{}".format(Xcache.XCACHE_MODULES_TASK_LIST, task_uuid))
+            keys.append("{}_{}".format(Xcache.XCACHE_MODULES_TASK_INSTANCE, task_uuid))
+        Xcache.delete_many(keys)
+        pipe = Xcache._redis().pipeline(transaction=True)
+        pipe.srem(Xcache.XCACHE_MODULES_TASK_INDEX, *task_uuids)
+        Xcache.incr_data_version(Xcache.DATA_VERSION_MODULE_TASK, pipe)
+        pipe.execute()
         return True
 
     @staticmethod
     def del_module_task_by_uuid(task_uuid):
         key = "{}_{}".format(Xcache.XCACHE_MODULES_TASK_LIST, task_uuid)
-        cache.delete(key)
+        instance_key = "{}_{}".format(Xcache.XCACHE_MODULES_TASK_INSTANCE, task_uuid)
+        cache.delete_many([key, instance_key])
+        pipe = Xcache._redis().pipeline(transaction=True)
+        pipe.srem(Xcache.XCACHE_MODULES_TASK_INDEX, task_uuid)
+        Xcache.incr_data_version(Xcache.DATA_VERSION_MODULE_TASK, pipe)
+        pipe.execute()
 
     # XCACHE_BOT_MODULES_WAIT_LIST
 
     @staticmethod
     def pop_one_from_bot_wait():
-        re_key = "{}_*".format(Xcache.XCACHE_BOT_MODULES_WAIT_LIST)
-        keys = cache.keys(re_key)
-
-        for key in keys:
+        while True:
+            # SPOP为原子操作,多进程同时获取时不会重复执行
+            member = Xcache._redis().spop(Xcache.XCACHE_BOT_MODULES_WAIT_INDEX)
+            if member is None:
+                return None
+            key = "{}_{}".format(Xcache.XCACHE_BOT_MODULES_WAIT_LIST, member.decode('utf-8'))
             req = cache.get(key)
             if req is not None:
                 cache.delete(key)
+                Xcache.incr_data_version(Xcache.DATA_VERSION_BOT_WAIT)
                 return req
-        return None
 
     @staticmethod
     def list_bot_wait():
-        re_key = "{}_*".format(Xcache.XCACHE_BOT_MODULES_WAIT_LIST)
-
-        keys = cache.keys(re_key)
-        reqs = []
-        for key in keys:
-            reqs.append(cache.get(key))
+        reqs = Xcache._list_by_index(Xcache.XCACHE_BOT_MODULES_WAIT_INDEX, Xcache.XCACHE_BOT_MODULES_WAIT_LIST)
         return reqs
 
     @staticmethod
@@ -229,59 +553,86 @@ class Xcache(object):
         """任务队列"""
         key = "{}_{}".format(Xcache.XCACHE_BOT_MODULES_WAIT_LIST, req.get("uuid"))
         cache.set(key, req, None)
+        pipe = Xcache._redis().pipeline(transaction=True)
+        pipe.sadd(Xcache.XCACHE_BOT_MODULES_WAIT_INDEX, req.get("uuid"))
+        Xcache.incr_data_version(Xcache.DATA_VERSION_BOT_WAIT, pipe)
+        pipe.execute()
         return True
 
     @staticmethod
     def del_bot_wait_by_group_uuid(group_uuid):
-        re_key = "{}_*".format(Xcache.XCACHE_BOT_MODULES_WAIT_LIST)
-        keys = cache.keys(re_key)
-        for key in keys:
-            req = cache.get(key)
+        reqs = Xcache.list_bot_wait()
+        for req in reqs:
             if req.get("group_uuid") == group_uuid:
+                key = "{}_{}".format(Xcache.XCACHE_BOT_MODULES_WAIT_LIST, req.get("uuid"))
                 cache.delete(key)
+                Xcache._index_remove(Xcache.XCACHE_BOT_MODULES_WAIT_INDEX, req.get("uuid"))
+        Xcache.incr_data_version(Xcache.DATA_VERSION_BOT_WAIT)
         return True
 
     @staticmethod
     def get_module_result(ipaddress, loadpath):
         key = "{}_{}_{}".format(Xcache.XCACHE_MODULES_RESULT, ipaddress, loadpath)
-        result_dict = cache.get(key)
-        if result_dict is None:
+        pipe = Xcache._redis().pipeline(transaction=False)
+        pipe.get(key)
+        pipe.hget(Xcache.XCACHE_MODULES_RESULT_UPDATE_TIME, key)
+        result, update_time = pipe.execute()
+        if result is None:
             return {"update_time": int(time.time()), "result": ""}
-        return result_dict
+        if update_time is None:
+            update_time = int(time.time())
+        return {"update_time": int(update_time), "result": result.decode('utf-8', 'ignore')}
 
     @staticmethod
     def set_module_result(ipaddress, loadpath, result):
         key = "{}_{}_{}".format(Xcache.XCACHE_MODULES_RESULT, ipaddress, loadpath)
-
-        cache.set(key, {"update_time": int(time.time()), "result": result}, None)
+        pipe = Xcache._redis().pipeline(transaction=True)
+        pipe.set(key, result)
+        pipe.hset(Xcache.XCACHE_MODULES_RESULT_UPDATE_TIME, key, int(time.time()))
+        pipe.sadd("{}_{}".format(Xcache.XCACHE_MODULES_RESULT_INDEX, ipaddress), loadpath)
+        pipe.execute()
         return True
 
     @staticmethod
     def add_module_result(ipaddress, loadpath, result):
+        """APPEND追加结果,无需读取已有内容"""
         key = "{}_{}_{}".format(Xcache.XCACHE_MODULES_RESULT, ipaddress, loadpath)
-        old_result = cache.get(key)
-        if old_result is None:
-            new_result = result
-        else:
-            new_result = old_result.get("result") + result
-
-        cache.set(key, {"update_time": int(time.time()), "result": new_result}, None)
+        pipe = Xcache._redis().pipeline(transaction=True)
+        pipe.append(key, result)
+        pipe.hset(Xcache.XCACHE_MODULES_RESULT_UPDATE_TIME, key, int(time.time()))
+        pipe.sadd("{}_{}".format(Xcache.XCACHE_MODULES_RESULT_INDEX, ipaddress), loadpath)
+        pipe.execute()
         return True
 
     @staticmethod
     def del_module_result_by_hid(ipaddress):
-        re_key = "{}_{}_*".format(Xcache.XCACHE_MODULES_RESULT, ipaddress)
-        keys = cache.keys(re_key)
-        for key in keys:
-            cache.set(key, None, None)
+        index = "{}_{}".format(Xcache.XCACHE_MODULES_RESULT_INDEX, ipaddress)
+        loadpaths = Xcache._index_members(index)
+        keys = ["{}_{}_{}".format(Xcache.XCACHE_MODULES_RESULT, ipaddress, loadpath) for loadpath in loadpaths]
+        pipe = Xcache._redis().pipeline(transaction=True)
+        if len(keys) > 0:
+            pipe.delete(*keys)
+            pipe.hdel(Xcache.XCACHE_MODULES_RESULT_UPDATE_TIME, *keys)
+        pipe.delete(index)
+        pipe.execute()
         return True
 
     @staticmethod
-    def list_module_result_history():
-        result = cache.get(Xcache.XCACHE_MODULES_RESULT_HISTORY)
-        if result is None:
-            return []
-        return result[::-1]
+    def list_module_result_history(start=0, count=None):
+        """按时间倒序读取历史结果,start/count用于分页"""
+        if count is None:
+            count = MODULE_RESULT_HISTORY_MAXLEN
+        entries = Xcache._redis().xrevrange(Xcache.XCACHE_MODULES_RESULT_HISTORY, count=start + count)
+        result = []
+        for entry_id, fields in entries[start:]:
+            try:
+                one_result = pickle.loads(fields[b"data"])
+            except Exception as E:
+                logger.warning(E)
+                continue
+            one_result["id"] = entry_id.decode('utf-8')
+            result.append(one_result)
+        return result
 
     @staticmethod
     def add_module_result_history(ipaddress=None, loadpath=None, opts=None, update_time=0, result=""):
@@ -292,93 +643,278 @@ class Xcache(object):
                       "opts": opts,
                       "update_time": update_time,
                       "result": result}
-        old_result = cache.get(Xcache.XCACHE_MODULES_RESULT_HISTORY)
-        if old_result is None:
-            cache.set(Xcache.XCACHE_MODULES_RESULT_HISTORY, [one_result], None)
-        else:
-            old_result.append(one_result)
-            cache.set(Xcache.XCACHE_MODULES_RESULT_HISTORY, old_result, None)
+        # stream追加为O(1),超出长度的旧记录由redis自动裁剪
+        redis_conn = Xcache._redis()
+        entry_id = redis_conn.xadd(Xcache.XCACHE_MODULES_RESULT_HISTORY,
+                                   {"data": pickle.dumps(one_result)},
+                                   maxlen=MODULE_RESULT_HISTORY_MAXLEN,
+                                   approximate=True)
+        # 按主机记录entry_id,删除主机时无需遍历全部历史
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.zadd("{}_{}".format(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOST_INDEX, ipaddress),
+                  {entry_id: Xcache._entry_id_score(entry_id)})
+        pipe.sadd(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOSTS, ipaddress)
+        Xcache.incr_data_version(Xcache.DATA_VERSION_RESULT_HISTORY, pipe)
+        pipe.xlen(Xcache.XCACHE_MODULES_RESULT_HISTORY)
+        pipe.incr(Xcache.XCACHE_MODULES_RESULT_HISTORY_PRUNE_COUNTER)
+        datas = pipe.execute()
+        # stream已满说明旧记录正在被裁剪,定期同步清理主机索引
+        if datas[-2] >= MODULE_RESULT_HISTORY_MAXLEN and datas[-1] % Xcache.RESULT_HISTORY_PRUNE_EVERY == 0:
+            Xcache.prune_module_result_history_index()
+        return True
 
+    @staticmethod
+    def _entry_id_score(entry_id):
+        if isinstance(entry_id, bytes):
+            entry_id = entry_id.decode('utf-8')
+        return int(entry_id.split("-")[0])
+
+    @staticmethod
+    def prune_module_result_history_index():
+        """删除主机索引中早于stream第一条记录的entry_id(已被MAXLEN裁剪),索引为空的主机一并删除"""
+        redis_conn = Xcache._redis()
+        ipaddresses = Xcache._index_members(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOSTS)
+        if len(ipaddresses) == 0:
+            return True
+        first = redis_conn.xrange(Xcache.XCACHE_MODULES_RESULT_HISTORY, count=1)
+        # 同一毫秒内被裁剪的少量记录留到下次清理,xdel不存在的entry_id无副作用
+        max_score = "({}".format(Xcache._entry_id_score(first[0][0])) if len(first) > 0 else "+inf"
+        pipe = redis_conn.pipeline(transaction=False)
+        for ipaddress in ipaddresses:
+            index = "{}_{}".format(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOST_INDEX, ipaddress)
+            pipe.zremrangebyscore(index, "-inf", max_score)
+            pipe.zcard(index)
+        datas = pipe.execute()
+        empty = [ipaddress for i, ipaddress in enumerate(ipaddresses) if datas[i * 2 + 1] == 0]
+        if len(empty) > 0:
+            redis_conn.srem(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOSTS, *empty)
         return True
 
     @staticmethod
     def del_module_result_history():
-        cache.set(Xcache.XCACHE_MODULES_RESULT_HISTORY, [], None)
+        redis_conn = Xcache._redis()
+        ipaddresses = Xcache._index_members(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOSTS)
+        pipe = redis_conn.pipeline(transaction=True)
+        for ipaddress in ipaddresses:
+            pipe.delete("{}_{}".format(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOST_INDEX, ipaddress))
+        pipe.delete(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOSTS)
+        pipe.delete(Xcache.XCACHE_MODULES_RESULT_HISTORY)
+        pipe.delete(Xcache.XCACHE_MODULES_RESULT_HISTORY_PRUNE_COUNTER)
+        Xcache.incr_data_version(Xcache.DATA_VERSION_RESULT_HISTORY, pipe)
+        pipe.execute()
         return True
 
     @staticmethod
     def del_module_result_history_by_hid(ipaddress):
-        old_result = cache.get(Xcache.XCACHE_MODULES_RESULT_HISTORY)
-        if old_result is None:
+        redis_conn = Xcache._redis()
+        index = "{}_{}".format(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOST_INDEX, ipaddress)
+        entry_ids = redis_conn.zrange(index, 0, -1)
+        if len(entry_ids) == 0:
             return False
-        else:
-            new_result = []
-            for one_result in old_result:
-                if one_result.get("ipaddress") != ipaddress:
-                    new_result.append(one_result)
-
-            cache.set(Xcache.XCACHE_MODULES_RESULT_HISTORY, new_result, None)
+        pipe = redis_conn.pipeline(transaction=True)
+        pipe.xdel(Xcache.XCACHE_MODULES_RESULT_HISTORY, *entry_ids)
+        pipe.delete(index)
+        pipe.srem(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOSTS, ipaddress)
+        Xcache.incr_data_version(Xcache.DATA_VERSION_RESULT_HISTORY, pipe)
+        pipe.execute()
         return True
 
     @staticmethod
     def get_module_task_length():
-        re_key = "{}_*".format(Xcache.XCACHE_MODULES_TASK_LIST)
-        keys = cache.keys(re_key)
-        return len(keys)
+        return Xcache._redis().scard(Xcache.XCACHE_MODULES_TASK_INDEX)
 
     @staticmethod
-    def get_notices():
-        notices = cache.get(Xcache.XCACHE_NOTICES_LIST)
-        if notices is None:
-            return []
-        else:
-            notices.reverse()
-            return notices
+    def _load_notice_entries(entries):
+        notices = []
+        for entry_id, fields in entries:
+            try:
+                notice = pickle.loads(fields[b"data"])
+            except Exception as E:
+                logger.warning(E)
+                continue
+            notice["id"] = entry_id.decode('utf-8')
+            notices.append(notice)
+        return notices
+
+    @staticmethod
+    def get_notices(start=0, count=None):
+        """按时间倒序读取通知,start/count用于分页"""
+        if count is None:
+            count = NOTICES_MAXLEN
+        entries = Xcache._redis().xrevrange(Xcache.XCACHE_NOTICES_LIST, count=start + count)
+        return Xcache._load_notice_entries(entries[start:])
+
+    @staticmethod
+    def get_notices_after(last_id):
+        """读取last_id之后的新通知,按时间倒序返回"""
+        if last_id is None:
+            return Xcache.get_notices()
+        entries = Xcache._redis().xrevrange(Xcache.XCACHE_NOTICES_LIST, min=last_id, count=NOTICES_MAXLEN)
+        entries = [entry for entry in entries if entry[0].decode('utf-8') != last_id]
+        return Xcache._load_notice_entries(entries)
+
+    @staticmethod
+    def get_notices_last_id():
+        entries = Xcache._redis().xrevrange(Xcache.XCACHE_NOTICES_LIST, count=1)
+        if len(entries) == 0:
+            return "0-0"
+        return entries[0][0].decode('utf-8')
 
     @staticmethod
     def clean_notices():
-        cache.set(Xcache.XCACHE_NOTICES_LIST, [], None)
+        pipe = Xcache._redis().pipeline(transaction=True)
+        pipe.delete(Xcache.XCACHE_NOTICES_LIST)
+        Xcache.incr_data_version(Xcache.DATA_VERSION_NOTICES_CLEAN, pipe)
+        pipe.execute()
         return True
 
     @staticmethod
     def add_one_notice(notice):
-        notices = cache.get(Xcache.XCACHE_NOTICES_LIST)
-        if notices is None:
-            cache.set(Xcache.XCACHE_NOTICES_LIST, [notice], None)
-        else:
-            tempnotices = copy.deepcopy(notices)
-            tempnotices.append(notice)
-            cache.set(Xcache.XCACHE_NOTICES_LIST, tempnotices, None)
+        pipe = Xcache._redis().pipeline(transaction=True)
+        pipe.xadd(Xcache.XCACHE_NOTICES_LIST,
+                  {"data": pickle.dumps(notice)},
+                  maxlen=NOTICES_MAXLEN,
+                  approximate=True)
+        Xcache.incr_data_version(Xcache.DATA_VERSION_NOTICES, pipe)
+        pipe.execute()
 
     @staticmethod
     def list_moduleconfigs():
-        modules_config = cache.get(Xcache.XCACHE_MODULES_CONFIG)
+        """模块概要列表(不含OPTIONS及内部模块),由update_moduleconfigs预先生成"""
+        modules_config = Xcache._local_get(Xcache.XCACHE_MODULES_CONFIG)
         if modules_config is None:
             return None
         else:
             return modules_config
 
     @staticmethod
-    def update_moduleconfigs(all_modules_config):
-        cache.set(Xcache.XCACHE_MODULES_CONFIG, all_modules_config, None)
+    def update_moduleconfigs(all_modules_config, modules_config_summary):
+        mapping = {}
+        for config in all_modules_config:
+            mapping[config.get("loadpath")] = pickle.dumps(config)
+        pipe = Xcache._redis().pipeline(transaction=True)
+        pipe.delete(Xcache.XCACHE_MODULES_CONFIG_HASH)
+        if len(mapping) > 0:
+            pipe.hset(Xcache.XCACHE_MODULES_CONFIG_HASH, mapping=mapping)
+        pipe.execute()
+        Xcache._local_set(Xcache.XCACHE_MODULES_CONFIG, modules_config_summary, None)
+        return True
+
+    @staticmethod
+    def clean_moduleconfigs():
+        Xcache._redis().delete(Xcache.XCACHE_MODULES_CONFIG_HASH)
+        Xcache._local_set(Xcache.XCACHE_MODULES_CONFIG, None, None)
         return True
 
     @staticmethod
     def get_moduleconfig(loadpath):
-        modules_config = cache.get(Xcache.XCACHE_MODULES_CONFIG)
         try:
-            for config in modules_config:
-                if config.get("loadpath") == loadpath:
-                    return config
-            return None
+            data = Xcache._redis().hget(Xcache.XCACHE_MODULES_CONFIG_HASH, loadpath)
+            if data is None:
+                return None
+            return pickle.loads(data)
         except Exception as E:
             logger.error(E)
             return None
 
+    @staticmethod
+    def get_moduleconfigs(loadpaths):
+        """HMGET批量获取模块配置,返回{loadpath: config}"""
+        loadpaths = list(set(loadpaths))
+        if len(loadpaths) == 0:
+            return {}
+        configs = {}
+        try:
+            datas = Xcache._redis().hmget(Xcache.XCACHE_MODULES_CONFIG_HASH, loadpaths)
+            for loadpath, data in zip(loadpaths, datas):
+                if data is not None:
+                    configs[loadpath] = pickle.loads(data)
+        except Exception as E:
+            logger.error(E)
+        return configs
+
     @staticmethod
     def set_session_info(sessionid, session_info):
         key = "{}_{}".format(Xcache.XCACHE_SESSION_INFO, sessionid)
         cache.set(key, session_info, None)
+        Xcache._index_add(Xcache.XCACHE_SESSION_INFO_INDEX, sessionid)
+        return True
+
+    @staticmethod
+    def add_session_events(events):
+        """session生命周期事件写入stream并发布,一次往返"""
+        if len(events) == 0:
+            return True
+        pipe = Xcache._redis().pipeline(transaction=False)
+        for event in events:
+            data = json.dumps(event)
+            pipe.xadd(Xcache.XCACHE_SESSION_EVENTS, {"data": data}, maxlen=SESSION_EVENTS_MAXLEN, approximate=True)
+            pipe.publish(VIPER_SESSION_EVENT_CHANNEL, data)
+        pipe.execute()
+        return True
+
+    @staticmethod
+    def get_session_events(start=0, count=None):
+        """按时间倒序读取session事件,start/count用于分页"""
+        if count is None:
+            count = SESSION_EVENTS_MAXLEN
+        entries = Xcache._redis().xrevrange(Xcache.XCACHE_SESSION_EVENTS, count=start + count)
+        events = []
+        for entry_id, fields in entries[start:]:
+            try:
+                event = json.loads(fields[b"data"])
+            except Exception as E:
+                logger.warning(E)
+                continue
+            event["id"] = entry_id.decode('utf-8')
+            events.append(event)
+        return events
+
+    @staticmethod
+    def add_msfrpc_metrics(metrics):
+        """累加进程内汇总的msfrpc调用统计,metrics为{method: (计数增量, 调用位置增量)},一次往返"""
+        if len(metrics) == 0:
+            return True
+        try:
+            pipe = Xcache._redis().pipeline(transaction=False)
+            pipe.sadd(Xcache.XCACHE_MSFRPC_METRICS_INDEX, *metrics.keys())
+            for method, (counters, callers) in metrics.items():
+                for field, value in counters.items():
+                    pipe.hincrby(f"{Xcache.XCACHE_MSFRPC_METRICS}:{method}", field, value)
+                for caller, value in callers.items():
+                    pipe.hincrby(f"{Xcache.XCACHE_MSFRPC_METRICS_CALLERS}:{method}", caller, value)
+            pipe.execute()
+        except Exception as E:
+            logger.warning(E)
+            return False
+        return True
+
+    @staticmethod
+    def list_msfrpc_metrics():
+        """返回{method: {"counters": {字段: 值}, "callers": {调用位置: 次数}}}"""
+        methods = Xcache._index_members(Xcache.XCACHE_MSFRPC_METRICS_INDEX)
+        if len(methods) == 0:
+            return {}
+        pipe = Xcache._redis().pipeline(transaction=False)
+        for method in methods:
+            pipe.hgetall(f"{Xcache.XCACHE_MSFRPC_METRICS}:{method}")
+            pipe.hgetall(f"{Xcache.XCACHE_MSFRPC_METRICS_CALLERS}:{method}")
+        datas = pipe.execute()
+        metrics = {}
+        for i, method in enumerate(methods):
+            counters = {key.decode('utf-8'): int(value) for key, value in datas[i * 2].items()}
+            callers = {key.decode('utf-8'): int(value) for key, value in datas[i * 2 + 1].items()}
+            metrics[method] = {"counters": counters, "callers": callers}
+        return metrics
+
+    @staticmethod
+    def clean_msfrpc_metrics():
+        methods = Xcache._index_members(Xcache.XCACHE_MSFRPC_METRICS_INDEX)
+        keys = [Xcache.XCACHE_MSFRPC_METRICS_INDEX]
+        for method in methods:
+            keys.append(f"{Xcache.XCACHE_MSFRPC_METRICS}:{method}")
+            keys.append(f"{Xcache.XCACHE_MSFRPC_METRICS_CALLERS}:{method}")
+        Xcache._redis().delete(*keys)
         return True
 
     @staticmethod
@@ -545,85 +1081,73 @@ class Xcache(object):
 
     @staticmethod
     def set_telegram_conf(conf):
-        cache.set(Xcache.XCACHE_TELEGRAM_CONFIG, conf, None)
+        Xcache._local_set(Xcache.XCACHE_TELEGRAM_CONFIG, conf, None)
         return True
 
     @staticmethod
     def get_telegram_conf():
-        conf = cache.get(Xcache.XCACHE_TELEGRAM_CONFIG)
+        conf = Xcache._local_get(Xcache.XCACHE_TELEGRAM_CONFIG)
         return conf
 
     @staticmethod
     def set_dingding_conf(conf):
-        cache.set(Xcache.XCACHE_DINGDING_CONFIG, conf, None)
+        Xcache._local_set(Xcache.XCACHE_DINGDING_CONFIG, conf, None)
         return True
 
     @staticmethod
     def get_dingding_conf():
-        conf = cache.get(Xcache.XCACHE_DINGDING_CONFIG)
+        conf = Xcache._local_get(Xcache.XCACHE_DINGDING_CONFIG)
         return conf
 
     @staticmethod
     def set_serverchan_conf(conf):
-        cache.set(Xcache.XCACHE_SERVERCHAN_CONFIG, conf, None)
+        Xcache._local_set(Xcache.XCACHE_SERVERCHAN_CONFIG, conf, None)
         return True
 
     @staticmethod
     def get_serverchan_conf():
-        conf = cache.get(Xcache.XCACHE_SERVERCHAN_CONFIG)
+        conf = Xcache._local_get(Xcache.XCACHE_SERVERCHAN_CONFIG)
         return conf
 
     @staticmethod
     def set_fofa_conf(conf):
-        cache.set(Xcache.XCACHE_FOFA_CONFIG, conf, None)
+        Xcache._local_set(Xcache.XCACHE_FOFA_CONFIG, conf, None)
         return True
 
     @staticmethod
     def get_fofa_conf():
-        conf = cache.get(Xcache.XCACHE_FOFA_CONFIG)
+        conf = Xcache._local_get(Xcache.XCACHE_FOFA_CONFIG)
         return conf
 
     @staticmethod
     def set_sessionmonitor_conf(conf):
-        cache.set(Xcache.XCACHE_SESSIONMONITOR_CONFIG, conf, None)
+        Xcache._local_set(Xcache.XCACHE_SESSIONMONITOR_CONFIG, conf, None)
         return True
 
     @staticmethod
     def get_sessionmonitor_conf():
-        conf = cache.get(Xcache.XCACHE_SESSIONMONITOR_CONFIG)
+        conf = Xcache._local_get(Xcache.XCACHE_SESSIONMONITOR_CONFIG)
         if conf is None:
             conf = {"flag": False}
-            cache.set(Xcache.XCACHE_SESSIONMONITOR_CONFIG, conf, None)
-        return conf
-
-    @staticmethod
-    def set_session_count(count):
-        cache.set(Xcache.XCACHE_SESSION_CONT, count, None)
-        return True
-
-    @staticmethod
-    def get_session_count():
-        conf = cache.get(Xcache.XCACHE_SESSION_CONT)
-        if conf is None:
-            return 0
+            Xcache._local_set(Xcache.XCACHE_SESSIONMONITOR_CONFIG, conf, None)
         return conf
 
     @staticmethod
     def get_lhost_config():
-        cache_data = cache.get(Xcache.XCACHE_MSFRPC_CONFIG)
+        cache_data = Xcache._local_get(Xcache.XCACHE_MSFRPC_CONFIG)
         return cache_data
 
     @staticmethod
     def set_lhost_config(cache_data):
-        cache.set(Xcache.XCACHE_MSFRPC_CONFIG, cache_data, None)
+        Xcache._local_set(Xcache.XCACHE_MSFRPC_CONFIG, cache_data, None)
         return True
 
     @staticmethod
     def get_aes_key():
-        conf = cache.get(Xcache.XCACHE_AES_KEY)
+        conf = Xcache._local_get(Xcache.XCACHE_AES_KEY)
         if conf is None:
             tmp_self_uuid = str(uuid.uuid1()).replace('-', "")[0:16]
-            cache.set(Xcache.XCACHE_AES_KEY, tmp_self_uuid, None)
+            Xcache._local_set(Xcache.XCACHE_AES_KEY, tmp_self_uuid, None)
             return tmp_self_uuid
         else:
             return conf
@@ -648,6 +1172,17 @@ class Xcache(object):
         cache_data = cache.get(f"{Xcache.XCACHE_GEOIP_CITYREADER}:{ip}")
         return cache_data
 
+    @staticmethod
+    def get_city_reader_cache_many(ips):
+        keys = {f"{Xcache.XCACHE_GEOIP_CITYREADER}:{ip}": ip for ip in ips}
+        cache_data = Xcache.get_many(list(keys.keys()))
+        return {keys.get(key): value for key, value in cache_data.items()}
+
+    @staticmethod
+    def set_city_reader_cache_many(data):
+        Xcache.set_many({f"{Xcache.XCACHE_GEOIP_CITYREADER}:{ip}": value for ip, value in data.items()}, 3600 * 24)
+        return True
+
     @staticmethod
     def set_asn_reader_cache(ip, cache_data):
         cache.set(f"{Xcache.XCACHE_GEOIP_ASNREADER}:{ip}", cache_data, 3600 * 24)  # 24小时是为了mmdb更新时启用
@@ -660,55 +1195,66 @@ class Xcache(object):
 
     @staticmethod
     def get_sessionio_cache(hid):
-        cache_dict = cache.get(Xcache.XCACHE_SESSIONIO_CACHE)
-        if cache_dict is None:
-            cache_dict = {hid: ''}
-            cache.set(Xcache.XCACHE_SESSIONIO_CACHE, cache_dict)
-            return {'hid': hid, 'buffer': ''}
-
-        if cache_dict.get(hid) is None:
-            cache_dict[hid] = ''
-            cache.set(Xcache.XCACHE_SESSIONIO_CACHE, cache_dict)
-            return {'hid': hid, 'buffer': ''}
-        old_buffer = cache_dict.get(hid)
-        return {'hid': hid, 'buffer': old_buffer}
+        key = "{}_{}".format(Xcache.XCACHE_SESSIONIO_CACHE, hid)
+        buffer = Xcache._redis().getrange(key, -SESSIONIO_CACHE_MAXBYTES, -1)
+        return {'hid': hid, 'buffer': buffer.decode('utf-8', 'ignore')}
 
     @staticmethod
     def add_sessionio_cache(hid, buffer):
-        cache_dict = cache.get(Xcache.XCACHE_SESSIONIO_CACHE)
-        if cache_dict is None:
-            cache_dict = {hid: buffer}
-            cache.set(Xcache.XCACHE_SESSIONIO_CACHE, cache_dict)
-            return {'hid': hid, 'buffer': buffer}
-        if cache_dict.get(hid) is None:
-            cache_dict[hid] = buffer
-            cache.set(Xcache.XCACHE_SESSIONIO_CACHE, cache_dict)
-            return {'hid': hid, 'buffer': buffer}
-
-        new_buffer = cache_dict.get(hid) + buffer
-        cache_dict[hid] = new_buffer
-        cache.set(Xcache.XCACHE_SESSIONIO_CACHE, cache_dict)
-        return {'hid': hid, 'buffer': new_buffer}
+        """每个主机独立的环形缓冲区,只保留最近SESSIONIO_CACHE_MAXBYTES字节"""
+        key = "{}_{}".format(Xcache.XCACHE_SESSIONIO_CACHE, hid)
+        tail = Xcache._redis().eval(Xcache._SESSIONIO_APPEND_SCRIPT, 1, key, buffer, SESSIONIO_CACHE_MAXBYTES)
+        return {'hid': hid, 'buffer': tail.decode('utf-8', 'ignore')}
 
     @staticmethod
     def del_sessionio_cache(hid):
-        cache_dict = cache.get(Xcache.XCACHE_SESSIONIO_CACHE)
-        if cache_dict is None:
-            cache_dict = {hid: ''}
-            cache.set(Xcache.XCACHE_SESSIONIO_CACHE, cache_dict)
-            return {'hid': hid, 'buffer': ''}
-        cache_dict[hid] = ''
-        cache.set(Xcache.XCACHE_SESSIONIO_CACHE, cache_dict)
+        key = "{}_{}".format(Xcache.XCACHE_SESSIONIO_CACHE, hid)
+        Xcache._redis().delete(key)
         return {'hid': hid, 'buffer': ''}
 
+    @staticmethod
+    def del_hosts_cache(hosts):
+        """删除主机相关的全部缓存(session命令行,模块结果,模块历史结果)
+        hosts为[{"id": hid, "ipaddress": ipaddress}],无论主机数量均为两次redis往返
+        """
+        if len(hosts) == 0:
+            return True
+        redis_conn = Xcache._redis()
+
+        # 第一次往返:读取每个主机的索引
+        pipe = redis_conn.pipeline(transaction=False)
+        for host in hosts:
+            pipe.smembers("{}_{}".format(Xcache.XCACHE_MODULES_RESULT_INDEX, host.get("ipaddress")))
+            pipe.zrange("{}_{}".format(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOST_INDEX, host.get("ipaddress")), 0, -1)
+        indexes = pipe.execute()
+
+        # 第二次往返:在一个MULTI中删除所有数据
+        pipe = redis_conn.pipeline(transaction=True)
+        for i, host in enumerate(hosts):
+            ipaddress = host.get("ipaddress")
+            loadpaths = indexes[i * 2]
+            entry_ids = indexes[i * 2 + 1]
+
+            pipe.delete("{}_{}".format(Xcache.XCACHE_SESSIONIO_CACHE, host.get("id")))
+
+            result_keys = ["{}_{}_{}".format(Xcache.XCACHE_MODULES_RESULT, ipaddress, loadpath.decode('utf-8'))
+                           for loadpath in loadpaths]
+            if len(result_keys) > 0:
+                pipe.delete(*result_keys)
+                pipe.hdel(Xcache.XCACHE_MODULES_RESULT_UPDATE_TIME, *result_keys)
+            pipe.delete("{}_{}".format(Xcache.XCACHE_MODULES_RESULT_INDEX, ipaddress))
+
+            if len(entry_ids) > 0:
+                pipe.xdel(Xcache.XCACHE_MODULES_RESULT_HISTORY, *entry_ids)
+            pipe.delete("{}_{}".format(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOST_INDEX, ipaddress))
+            pipe.srem(Xcache.XCACHE_MODULES_RESULT_HISTORY_HOSTS, ipaddress)
+        Xcache.incr_data_version(Xcache.DATA_VERSION_RESULT_HISTORY, pipe)
+        pipe.execute()
+        return True
+
     @staticmethod
     def list_lazyloader():
-        re_key = "{}_*".format(Xcache.XCACHE_LAZYLOADER_CACHE)
-        keys = cache.keys(re_key)
-        reqs = []
-        for key in keys:
-            req = cache.get(key)
-            reqs.append(req)
+        reqs = Xcache._list_by_index(Xcache.XCACHE_LAZYLOADER_INDEX, Xcache.XCACHE_LAZYLOADER_CACHE)
         return reqs
 
     @staticmethod
@@ -721,10 +1267,12 @@ class Xcache(object):
     def set_lazyloader_by_uuid(loader_uuid, data):
         key = f"{Xcache.XCACHE_LAZYLOADER_CACHE}_{loader_uuid}"
         cache.set(key, data, None)
+        Xcache._index_add(Xcache.XCACHE_LAZYLOADER_INDEX, loader_uuid)
         return True
 
     @staticmethod
     def del_lazyloader_by_uuid(loader_uuid):
         key = f"{Xcache.XCACHE_LAZYLOADER_CACHE}_{loader_uuid}"
         cache.delete(key)
+        Xcache._index_remove(Xcache.XCACHE_LAZYLOADER_INDEX, loader_uuid)
         return True
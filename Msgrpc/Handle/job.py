@@ -5,88 +5,63 @@
 import copy
 import time
 
-from Lib.Module.configs import HANDLER_OPTION, BROKER
+from Lib.Module.configs import BROKER
 from Lib.api import data_return
 from Lib.apsmodule import aps_module
 from Lib.configs import Job_MSG, CODE_MSG
 from Lib.log import logger
 from Lib.method import Method
+from Lib.moduletask import ModuleTask
 from Lib.notice import Notice
 from Lib.rpcclient import RpcClient
 from Lib.xcache import Xcache
-from Msgrpc.serializers import PostModuleSerializer, BotModuleSerializer
+from Msgrpc.serializers import BotModuleSerializer
 
 
 class Job(object):
 
     @staticmethod
-    def list_jobs():
-        """获取后台任务列表,包括msf任务及本地多模块任务"""
-
-        msf_jobs_dict = Job.list_msfrpc_jobs_no_cache()
-        if msf_jobs_dict is None:  # msfrpc临时异常
+    def list_jobs(msf_jobs_dict=None, fetched=False):
+        """获取后台任务列表,包括msf任务及本地多模块任务
+        fetched为True时msf_jobs_dict为调用方已获取的msf任务列表(None表示msfrpc不可用),否则重新获取
+        """
+        if not fetched:
+            msf_jobs_dict = Job.list_msfrpc_jobs_no_cache()
+        if msf_jobs_dict is None:  # msfrpc临时异常或熔断
             uncheck = True  # 跳过任务检查
             msf_jobs_dict = {}
         else:
             uncheck = False
 
-        reqs = Xcache.list_module_tasks()
+        # 任务描述中已包含入队时序列化的moduleinfo,无需反序列化模块实例
+        reqs = ModuleTask.list()
         reqs_temp = []
         for req in reqs:
             # post python module
             if req.get("job_id") is None:
-                req["moduleinfo"] = PostModuleSerializer(req.get("module"), many=False).data
-                req["moduleinfo"]['_custom_param'] = Job._deal_dynamic_param(req["moduleinfo"]['_custom_param'])
-                req.pop("module")  # 弹出module实例
                 reqs_temp.append(req)
                 continue
 
             # post msf module
             # 跳过任务检查
             if uncheck:
-                req["moduleinfo"] = PostModuleSerializer(req.get("module"), many=False).data
-                req.pop("module")  # 弹出module实例
-                req["moduleinfo"]['_custom_param'] = Job._deal_dynamic_param(req["moduleinfo"]['_custom_param'])
                 reqs_temp.append(req)
                 continue
             elif msf_jobs_dict.get(str(req.get("job_id"))) is not None:
-                req["moduleinfo"] = PostModuleSerializer(req.get("module"), many=False).data
-                req["moduleinfo"]['_custom_param'] = Job._deal_dynamic_param(req["moduleinfo"]['_custom_param'])
-                req.pop("module")  # 弹出module实例
                 reqs_temp.append(req)
                 continue
             else:
                 # 清除失效的任务
                 if int(time.time()) - req.get("time") >= 30:
-                    logger.error(f"清除失效的任务: {req.get('module').NAME}")
+                    logger.error(f"清除失效的任务: {req.get('name')}")
                     logger.error(req)
-                    Xcache.del_module_task_by_uuid(req.get("uuid"))
+                    ModuleTask.delete(req.get("uuid"))
                 else:
                     # 如果创建时间不足30秒,则等待callback处理数据
-                    req["moduleinfo"] = PostModuleSerializer(req.get("module"), many=False).data
-                    req["moduleinfo"]['_custom_param'] = Job._deal_dynamic_param(req["moduleinfo"]['_custom_param'])
-                    req.pop("module")
                     reqs_temp.append(req)
                     continue
         return reqs_temp
 
-    @staticmethod
-    def _deal_dynamic_param(_custom_param=None):
-        """处理handler及凭证等动态变化参数,返回处理后参数列表"""
-        if _custom_param is None:
-            return None
-        import json
-        if _custom_param.get(HANDLER_OPTION.get("name")) is not None:
-            new_option = {}
-            old_option = json.loads(_custom_param.get(HANDLER_OPTION.get("name")))
-            new_option["PAYLOAD"] = old_option.get("PAYLOAD")
-            new_option["LHOST"] = old_option.get("LHOST")
-            new_option["RHOST"] = old_option.get("RHOST")
-            new_option["LPORT"] = old_option.get("LPORT")
-            _custom_param[HANDLER_OPTION.get("name")] = json.dumps(new_option)
-
-        return _custom_param
-
     @staticmethod
     def list_bot_wait():
         bot_wait_show = {}
@@ -110,17 +85,14 @@ class Job(object):
 
     @staticmethod
     def list_msfrpc_jobs_no_cache():
-        infos = {}
+        """msfrpc不可用时返回None,与没有任务({})区分"""
         try:
             result = RpcClient.call(Method.JobList)
             Xcache.set_msf_job_cache(result)
-            if result is None:
-                infos = {}
-            else:
-                infos = result
+            return result
         except Exception as E:
             logger.error(E)
-        return infos
+            return None
 
     @staticmethod
     def list_msfrpc_jobs():
@@ -157,9 +129,9 @@ class Job(object):
                     context = data_return(204, Job_MSG.get(204), {"uuid": task_uuid, "job_id": job_id})
                     return context
             elif broker == BROKER.post_msf_job:
-                req = Xcache.get_module_task_by_uuid(task_uuid=task_uuid)
+                req = ModuleTask.get(task_uuid=task_uuid)
                 common_module_instance = req.get("module")
-                Xcache.del_module_task_by_uuid(task_uuid)
+                ModuleTask.delete(task_uuid)
                 params = [job_id]
                 result = RpcClient.call(Method.JobStop, params)
                 if result is None:
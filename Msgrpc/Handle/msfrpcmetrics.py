@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# @File  : msfrpcmetrics.py
+# @Date  : 2021/3/7
+# @Desc  :
+from Lib.api import data_return
+from Lib.configs import CODE_MSG
+from Lib.rpcclient import RpcMetrics
+from Lib.xcache import Xcache
+
+
+class MsfrpcMetrics(object):
+    """msfrpc调用统计"""
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def list_summary():
+        """各方法的汇总信息,按总耗时倒序"""
+        metrics = Xcache.list_msfrpc_metrics()
+        result = []
+        for method, one in metrics.items():
+            summary = RpcMetrics.summary(one.get("counters"))
+            summary["method"] = method
+            summary["latency_ms_sum"] = one.get("counters").get("latency_ms_sum", 0)
+            result.append(summary)
+        result.sort(key=lambda x: x.get("latency_ms_sum"), reverse=True)
+        return result
+
+    @staticmethod
+    def list(top=10):
+        """汇总信息,原始计数及调用次数最多的top个调用位置"""
+        metrics = Xcache.list_msfrpc_metrics()
+        result = []
+        for method, one in metrics.items():
+            counters = one.get("counters")
+            callers = sorted(one.get("callers").items(), key=lambda x: x[1], reverse=True)[:top]
+            result.append({"method": method,
+                           "summary": RpcMetrics.summary(counters),
+                           "counters": counters,
+                           "callers": [{"caller": caller, "count": count} for caller, count in callers]})
+        result.sort(key=lambda x: x.get("counters").get("latency_ms_sum", 0), reverse=True)
+        context = data_return(200, CODE_MSG.get(200), result)
+        return context
+
+    @staticmethod
+    def destory():
+        Xcache.clean_msfrpc_metrics()
+        context = data_return(204, CODE_MSG.get(204), {})
+        return context
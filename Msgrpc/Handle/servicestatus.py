@@ -6,7 +6,8 @@ from Lib.api import data_return
 from Lib.configs import CODE_MSG
 from Lib.log import logger
 from Lib.method import Method
-from Lib.rpcclient import RpcClient
+from Lib.rpcclient import RpcClient, RpcBreaker
+from Msgrpc.Handle.msfrpcmetrics import MsfrpcMetrics
 
 
 class ServiceStatus(object):
@@ -37,4 +38,12 @@ class ServiceStatus(object):
             logger.warning("json_rpc服务无法连接,请确认!")
         else:
             data['json_rpc'] = {'status': True}
+        # 熔断状态,open时调用直接失败
+        data['json_rpc']['breaker'] = RpcBreaker.status()
+        # 各方法调用次数,错误数及耗时,详细信息见msfrpcmetrics接口
+        try:
+            data['json_rpc']['metrics'] = MsfrpcMetrics.list_summary()
+        except Exception as E:
+            logger.warning(E)
+            data['json_rpc']['metrics'] = []
         return data
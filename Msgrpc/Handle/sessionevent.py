@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# @File  : sessionevent.py
+# @Date  : 2021/3/7
+# @Desc  :
+from Lib.api import data_return
+from Lib.configs import CODE_MSG
+from Lib.xcache import Xcache
+
+
+class SessionEvent(object):
+    """session生命周期事件(opened/closed/info_updated/checkin_stale)"""
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def list(start=0, count=None):
+        """按时间倒序分页读取session事件"""
+        events = Xcache.get_session_events(start=start, count=count)
+        context = data_return(200, CODE_MSG.get(200), events)
+        return context
@@ -7,11 +7,11 @@ from Core.Handle.setting import Settings
 from Lib.api import data_return, is_empty_ports
 from Lib.configs import CODE_MSG, Socks_MSG
 from Lib.log import logger
+from Lib.method import Method
 from Lib.msfmodule import MSFModule
 from Lib.notice import Notice
+from Lib.rpcclient import RpcClient
 from Msgrpc.Handle.job import Job
-from Msgrpc.Handle.portfwd import PortFwd
-from Msgrpc.Handle.route import Route
 
 
 class Socks(object):
@@ -19,16 +19,24 @@ class Socks(object):
 
     @staticmethod
     def list():
-        route_list = Route.list_route()
         socks_list = Socks.list_msf_socks()
-        portfwds = PortFwd.list_portfwd()
         # 检查host对应的路由信息
         ipaddresses = []
 
         hosts = Host.list_hosts()
         for onehost in hosts:
             ipaddresses.append(onehost.get("ipaddress"))
-        route_session_list = Route.get_match_route_for_ipaddress_list(ipaddresses)
+
+        # 路由列表,端口转发列表及host路由信息,一次批量请求获取
+        route_list, portfwds, route_session_list = RpcClient.call_batch([
+            (Method.SessionMeterpreterRouteList, None),
+            (Method.SessionMeterpreterPortFwdList, None),
+            (Method.SessionMeterpreterRouteGet, [ipaddresses]),
+        ])
+        if route_list is None:
+            route_list = []
+        if portfwds is None:
+            portfwds = []
         if route_session_list is None:
             for host in hosts:
                 host['route'] = {'type': 'DIRECT', 'data': None}
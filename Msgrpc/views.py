@@ -17,11 +17,13 @@ from Msgrpc.Handle.filesession import FileSession
 from Msgrpc.Handle.handler import Handler
 from Msgrpc.Handle.job import Job
 from Msgrpc.Handle.lazyloader import LazyLoader
+from Msgrpc.Handle.msfrpcmetrics import MsfrpcMetrics
 from Msgrpc.Handle.payload import Payload
 from Msgrpc.Handle.portfwd import PortFwd
 from Msgrpc.Handle.route import Route
 from Msgrpc.Handle.servicestatus import ServiceStatus
 from Msgrpc.Handle.session import Session
+from Msgrpc.Handle.sessionevent import SessionEvent
 from Msgrpc.Handle.sessionio import SessionIO
 from Msgrpc.Handle.socks import Socks
 from Msgrpc.Handle.transport import Transport
@@ -154,6 +156,21 @@ class SessionView(BaseView):
         return Response(context)
 
 
+class SessionEventView(BaseView):
+    def list(self, request, **kwargs):
+        """session生命周期事件,start/count用于分页"""
+        try:
+            start = int(request.query_params.get('start', 0))
+            count = request.query_params.get('count', None)
+            if count is not None:
+                count = int(count)
+            context = SessionEvent.list(start=start, count=count)
+        except Exception as E:
+            logger.error(E)
+            context = data_return(500, CODE_MSG.get(500), {})
+        return Response(context)
+
+
 class RouteView(BaseView):
     def list(self, request, **kwargs):
         try:
@@ -447,6 +464,27 @@ class ServiceStatusView(BaseView):
         return Response(context)
 
 
+class MsfrpcMetricsView(BaseView):
+    def list(self, request, **kwargs):
+        """msfrpc各方法的调用统计"""
+        try:
+            top = int(request.query_params.get('top', 10))
+            context = MsfrpcMetrics.list(top)
+        except Exception as E:
+            logger.error(E)
+            context = data_return(500, CODE_MSG.get(500), {})
+        return Response(context)
+
+    def destroy(self, request, pk=None, **kwargs):
+        """清空统计"""
+        try:
+            context = MsfrpcMetrics.destory()
+        except Exception as E:
+            logger.error(E)
+            context = data_return(500, CODE_MSG.get(500), {})
+        return Response(context)
+
+
 class LazyLoaderView(BaseView):
     def list(self, request, **kwargs):
         """查询数据库中的信息"""
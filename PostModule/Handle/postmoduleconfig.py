@@ -26,43 +26,29 @@ class PostModuleConfig(object):
 
     @staticmethod
     def list(loadpath=None):
-        all_modules_config = Xcache.list_moduleconfigs()
-        if all_modules_config is None:
-            PostModuleConfig.load_all_modules_config()
-            all_modules_config = Xcache.list_moduleconfigs()
-
-        # 删除内部模块
-        for one in all_modules_config[:]:
-            if one.get('MODULETYPE') == TAG2CH.internal:
-                all_modules_config.remove(one)
-
         if loadpath is None:
-            for one in all_modules_config:
-                one['OPTIONS'] = []
-            context = data_return(200, CODE_MSG.get(200), all_modules_config)
+            modules_config_summary = Xcache.list_moduleconfigs()
+            if modules_config_summary is None:
+                PostModuleConfig.load_all_modules_config()
+                modules_config_summary = Xcache.list_moduleconfigs()
+            context = data_return(200, CODE_MSG.get(200), modules_config_summary)
             return context
         else:
-            for one_module_config in all_modules_config:
-                if one_module_config.get('loadpath') == loadpath:
-                    # 动态处理handler和凭证选项
-                    new_module_config = PostModuleConfig._deal_dynamic_option(one_module_config=one_module_config)
-                    context = data_return(200, CODE_MSG.get(200), new_module_config)
-                    return context
-            # 没有找到模块
-            context = data_return(200, CODE_MSG.get(200), {})
+            one_module_config = Xcache.get_moduleconfig(loadpath)
+            # 没有找到模块或内部模块
+            if one_module_config is None or one_module_config.get('MODULETYPE') == TAG2CH.internal:
+                context = data_return(200, CODE_MSG.get(200), {})
+                return context
+            # 动态处理handler和凭证选项
+            new_module_config = PostModuleConfig._deal_dynamic_option(one_module_config=one_module_config)
+            context = data_return(200, CODE_MSG.get(200), new_module_config)
             return context
 
     @staticmethod
     def update():
         PostModuleConfig.load_all_modules_config()
-        all_modules_config = Xcache.list_moduleconfigs()
-        # 删除内部模块
-        for one in all_modules_config[:]:
-            if one.get('MODULETYPE') == TAG2CH.internal:
-                all_modules_config.remove(one)
-        for one in all_modules_config:
-            one['OPTIONS'] = []
-        context = data_return(201, PostModuleConfig_MSG.get(201), all_modules_config)
+        modules_config_summary = Xcache.list_moduleconfigs()
+        context = data_return(201, PostModuleConfig_MSG.get(201), modules_config_summary)
         return context
 
     @staticmethod
@@ -190,7 +176,17 @@ class PostModuleConfig(object):
         Notice.send_success(f"自定义模块加载完成,加载{diy_module_count}个模块")
 
         all_modules_config.sort(key=lambda s: (TAG2CH.get_moduletype_order(s.get('MODULETYPE')), s.get('loadpath')))
-        if Xcache.update_moduleconfigs(all_modules_config):
+
+        # 预先生成模块列表接口使用的概要信息(删除内部模块,清空OPTIONS)
+        modules_config_summary = []
+        for one in all_modules_config:
+            if one.get('MODULETYPE') == TAG2CH.internal:
+                continue
+            one_summary = dict(one)
+            one_summary['OPTIONS'] = []
+            modules_config_summary.append(one_summary)
+
+        if Xcache.update_moduleconfigs(all_modules_config, modules_config_summary):
             return len(all_modules_config)
         else:
             return 0
@@ -3,7 +3,7 @@
 # @Date  : 2021/2/26
 # @Desc  :
 from Lib.api import data_return
-from Lib.configs import PostModuleResultHistory_MSG
+from Lib.configs import CODE_MSG, PostModuleResultHistory_MSG
 from Lib.log import logger
 from Lib.xcache import Xcache
 
@@ -13,12 +13,12 @@ class PostModuleResultHistory(object):
         pass
 
     @staticmethod
-    def list_all():
+    def list_all(start=0, count=None):
         try:
-            result = Xcache.list_module_result_history()
+            result = Xcache.list_module_result_history(start=start, count=count)
+            moduleconfigs = Xcache.get_moduleconfigs([one.get("loadpath") for one in result])
             for one in result:
-                loadpath = one.get("loadpath")
-                moduleconfig = Xcache.get_moduleconfig(loadpath)
+                moduleconfig = moduleconfigs.get(one.get("loadpath"))
                 if moduleconfig is None:
                     continue
                 one["module_name"] = moduleconfig.get("NAME")
@@ -27,6 +27,12 @@ class PostModuleResultHistory(object):
             logger.exception(E)
             return []
 
+    @staticmethod
+    def list(start=0, count=None):
+        result = PostModuleResultHistory.list_all(start=start, count=count)
+        context = data_return(200, CODE_MSG.get(200), result)
+        return context
+
     @staticmethod
     def destory():
         Xcache.del_module_result_history()
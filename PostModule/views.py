@@ -70,6 +70,18 @@ class PostModuleResultView(BaseView):
 
 
 class PostModuleResultHistoryView(BaseView):
+    def list(self, request, **kwargs):
+        try:
+            start = int(request.query_params.get('start', 0))
+            count = request.query_params.get('count', None)
+            if count is not None:
+                count = int(count)
+            context = PostModuleResultHistory.list(start=start, count=count)
+        except Exception as E:
+            logger.error(E)
+            context = data_return(500, CODE_MSG.get(500), {})
+        return Response(context)
+
     def destroy(self, request, *args, **kwargs):
         try:
 
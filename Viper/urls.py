@@ -4,8 +4,9 @@ from rest_framework import routers
 from Core.views import BaseAuthView, CurrentUserView, NoticesView, SettingView, HostView
 from Core.views import NetworkTopologyView, NetworkSearchView
 from Lib.montior import MainMonitor
-from Msgrpc.views import LazyLoaderView, LazyLoaderInterfaceView
+from Msgrpc.views import LazyLoaderView, LazyLoaderInterfaceView, MsfrpcMetricsView
 from Msgrpc.views import ServiceStatusView, PayloadView, JobView, HandlerView, SessionView, SessionIOView, RouteView
+from Msgrpc.views import SessionEventView
 from Msgrpc.views import SocksView, TransportView, FileMsfView, FileSessionView, PortFwdView, HostFileView
 from PostLateral.views import PortServiceView, CredentialView, VulnerabilityView
 from PostModule.views import PostModuleConfigView, PostModuleActuatorView, PostModuleResultView
@@ -21,11 +22,13 @@ router.register(r'api/v1/core/host', HostView, basename="Host")
 router.register(r'api/v1/core/networktopology', NetworkTopologyView, basename="NetworkTopology")
 router.register(r'api/v1/core/networksearch', NetworkSearchView, basename="NetworkSearch")
 router.register(r'api/v1/msgrpc/servicestatus', ServiceStatusView, basename="ServiceStatus")
+router.register(r'api/v1/msgrpc/msfrpcmetrics', MsfrpcMetricsView, basename="MsfrpcMetrics")
 router.register(r'api/v1/msgrpc/payload', PayloadView, basename="Payload")
 router.register(r'api/v1/msgrpc/job', JobView, basename="Job")
 router.register(r'api/v1/msgrpc/handler', HandlerView, basename="Handler")
 router.register(r'api/v1/msgrpc/session', SessionView, basename="Session")
 router.register(r'api/v1/msgrpc/sessionio', SessionIOView, basename="SessionIO")
+router.register(r'api/v1/msgrpc/sessionevent', SessionEventView, basename="SessionEvent")
 router.register(r'api/v1/msgrpc/route', RouteView, basename="Route")
 router.register(r'api/v1/msgrpc/socks', SocksView, basename="Socks")
 router.register(r'api/v1/msgrpc/portfwd', PortFwdView, basename="PortFwd")
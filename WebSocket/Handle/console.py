@@ -41,15 +41,13 @@ class Console(object):
         if result is None:
             Xcache.set_console_id(None)
         else:
-            consoles = result.get("consoles")
-            if len(consoles) == 0:
-                pass
-            else:
-                for console in consoles:  # 删除已知命令行
-                    cid = int(console.get("id"))
-                    params = [cid]
-                    RpcClient.call(Method.ConsoleDestroy, params)
-            result = RpcClient.call(Method.ConsoleCreate)
+            # 删除已知命令行并新建,一次批量请求完成
+            calls = []
+            for console in result.get("consoles"):
+                cid = int(console.get("id"))
+                calls.append((Method.ConsoleDestroy, [cid]))
+            calls.append((Method.ConsoleCreate, None))
+            result = RpcClient.call_batch(calls)[-1]
             if result is None:
                 Xcache.set_console_id(None)
             else:
@@ -2,21 +2,74 @@
 # @File  : heartbeat.py
 # @Date  : 2021/2/27
 # @Desc  :
-import copy
+import json
+import threading
 import time
 
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
 from Core.Handle.host import Host
 from Lib.External.geoip import Geoip
+from Lib.configs import HEARTBEAT_IDLE_TICKS, HEARTBEAT_MAX_INTERVAL, HEARTBEAT_EVENT_DEBOUNCE
 from Lib.log import logger
 from Lib.method import Method
 from Lib.notice import Notice
-from Lib.rpcclient import RpcClient
+from Lib.rpcclient import RpcClient, RpcBreaker
+from Lib.sessiontracker import SessionTracker
 from Lib.xcache import Xcache
 from Msgrpc.Handle.job import Job
 from PostModule.Handle.postmoduleresulthistory import PostModuleResultHistory
 
 
 class HeartBeat(object):
+    # 各部分依赖的数据版本号
+    SECTION_FAMILIES = {
+        "jobs": [Xcache.DATA_VERSION_MODULE_TASK],
+        "hosts_sorted": [Xcache.DATA_VERSION_HOSTS],
+        "result_history": [Xcache.DATA_VERSION_RESULT_HISTORY, Xcache.DATA_VERSION_HOSTS],
+        "notices": [Xcache.DATA_VERSION_NOTICES, Xcache.DATA_VERSION_NOTICES_CLEAN],
+        "bot_wait_list": [Xcache.DATA_VERSION_BOT_WAIT],
+        "task_queue_length": [Xcache.DATA_VERSION_MODULE_TASK],
+        "msfrpc_status": [],
+    }
+    # 数据来自msfrpc的部分定时轮询,其余部分由数据版本号变化事件触发
+    POLLED_SECTIONS = ["jobs", "hosts_sorted", "msfrpc_status"]
+    EVENT_SECTIONS = ["result_history", "notices", "bot_wait_list", "task_queue_length"]
+
+    # 心跳各部分上次计算时的数据版本号及结果,仅在心跳线程所在进程内维护
+    _section_versions = {}
+    _section_results = {}
+    # 每个部分同一时间只计算一次
+    _section_locks = {section: threading.Lock() for section in SECTION_FAMILIES}
+    # 主机列表按版本号缓存,版本号不变时无需查询数据库
+    _hosts_version = None
+    _hosts = None
+    _hosts_lock = threading.Lock()
+    # 增量模式:按实体key保存上次发送的实体,每次发布序号加一
+    DELTA_SECTIONS = ["hosts_sorted", "result_history"]
+    # 随时间变化的session字段,不参与实体比较,单独以 {key: [last_checkin, fromnow]} 发送
+    VOLATILE_SESSION_FIELDS = ["last_checkin", "fromnow"]
+    _delta_entities = {}
+    _delta_checkins = {}
+    _delta_seq = 0
+    # 发布顺序必须与序号一致
+    _publish_lock = threading.Lock()
+    # 写入快照时使用的通知列表,仅在通知变化时重新读取
+    _snapshot_notices = None
+    _snapshot_ready = False
+    # 快照中带 {section}_update 标记的部分,其余部分(task_queue_length, msfrpc_status)直接保存值
+    SNAPSHOT_UPDATE_SECTIONS = ["hosts_sorted", "result_history", "notices", "jobs", "bot_wait_list"]
+    # 等待执行的事件触发部分,同一部分只保留一次待执行的计算
+    _pending_sections = set()
+    _pending_lock = threading.Lock()
+    # 轮询部分的自适应频率,{section: {"interval": 秒, "idle": 连续无变化次数, "wait": 剩余跳过次数}}
+    _poll_state = {}
+    _subscribers = 0
+    _subscribers_lock = threading.Lock()
+    # session转换结果缓存,{sid: (原始信息指纹, 转换后的session)}
+    _session_cache = {}
+
     def __init__(self):
         pass
 
@@ -25,14 +78,13 @@ class HeartBeat(object):
         hosts_sorted = HeartBeat.list_hostandsession()
 
         result_history = PostModuleResultHistory.list_all()
-        for one in result_history:
-            for host in hosts_sorted:
-                if one.get("hid") == host.get("id"):
-                    one["ipaddress"] = host.get("ipaddress")
-                    break
-        Xcache.set_heartbeat_cache_result_history(result_history)
+        HeartBeat.attach_result_history_ipaddress(result_history, hosts_sorted)
 
         notices = Notice.list_notices()
+        if len(notices) > 0:
+            notices_last_id = notices[0].get("id")
+        else:
+            notices_last_id = Notice.get_last_id()
 
         jobs = Job.list_jobs()
 
@@ -41,6 +93,9 @@ class HeartBeat(object):
         # 任务队列长度
         task_queue_length = Xcache.get_module_task_length()
 
+        # msfrpc熔断状态(本进程)
+        msfrpc_status = RpcBreaker.status()
+
         result = {
             'hosts_sorted_update': True,
             'hosts_sorted': hosts_sorted,
@@ -48,150 +103,564 @@ class HeartBeat(object):
             'result_history': result_history,
             'notices_update': True,
             'notices': notices,
+            'notices_last_id': notices_last_id,
             'task_queue_length': task_queue_length,
             'jobs_update': True,
             'jobs': jobs,
             'bot_wait_list_update': True,
-            'bot_wait_list': bot_wait_list
+            'bot_wait_list': bot_wait_list,
+            'msfrpc_status': msfrpc_status,
         }
 
         return result
 
     @staticmethod
-    def get_heartbeat_result():
-        result = {}
+    def _section_unchanged(section, version):
+        return section in HeartBeat._section_results and HeartBeat._section_versions.get(section) == version
 
-        # jobs 列表 首先执行,刷新数据,删除过期任务
-        jobs = Job.list_jobs()
-        cache_jobs = Xcache.get_heartbeat_cache_jobs()
-        if cache_jobs == jobs:
-            result["jobs_update"] = False
-            result["jobs"] = []
-        else:
-            Xcache.set_heartbeat_cache_jobs(jobs)
-            result["jobs_update"] = True
-            result["jobs"] = jobs
+    @staticmethod
+    def _update_section(result, section, version, data):
+        """记录本次计算的版本号,结果与上次相同时不发送"""
+        HeartBeat._section_versions[section] = version
+        if section in HeartBeat._section_results and HeartBeat._section_results.get(section) == data:
+            return
+        HeartBeat._section_results[section] = data
+        result[f"{section}_update"] = True
+        result[section] = data
 
-        # hosts_sorted
-        hosts_sorted = HeartBeat.list_hostandsession()
-        cache_hosts_sorted = Xcache.get_heartbeat_cache_hosts_sorted()
-        if cache_hosts_sorted == hosts_sorted:
-            result["hosts_sorted_update"] = False
-            result["hosts_sorted"] = []
+    @staticmethod
+    def _jobs_wait_callback(msf_jobs_dict):
+        """是否存在msf任务已结束但仍在等待callback的任务(需要重新计算以清理失效任务)"""
+        for req in HeartBeat._section_results.get("jobs", []):
+            job_id = req.get("job_id")
+            if job_id is not None and msf_jobs_dict.get(str(job_id)) is None:
+                return True
+        return False
+
+    @staticmethod
+    def _get_hosts(versions):
+        """按版本号缓存的主机列表,返回浅拷贝,调用方可直接修改"""
+        hosts_version = versions.get(Xcache.DATA_VERSION_HOSTS, 0)
+        with HeartBeat._hosts_lock:
+            if HeartBeat._hosts is None or HeartBeat._hosts_version != hosts_version:
+                HeartBeat._hosts = Host.list_hosts()
+                HeartBeat._hosts_version = hosts_version
+            return [dict(host) for host in HeartBeat._hosts]
+
+    @staticmethod
+    def _produce_jobs(versions):
+        # 刷新msf任务缓存,删除过期任务
+        result = {}
+        msf_jobs_dict = Job.list_msfrpc_jobs_no_cache()
+        if msf_jobs_dict is None:  # msfrpc不可用,不清理任务
+            jobs_version = (versions.get(Xcache.DATA_VERSION_MODULE_TASK, 0), None)
+            if HeartBeat._section_unchanged("jobs", jobs_version):
+                return result
         else:
-            Xcache.set_heartbeat_cache_hosts_sorted(hosts_sorted)
-            result["hosts_sorted_update"] = True
-            result["hosts_sorted"] = hosts_sorted
+            jobs_version = (versions.get(Xcache.DATA_VERSION_MODULE_TASK, 0), tuple(sorted(msf_jobs_dict.keys())))
+            if HeartBeat._section_unchanged("jobs", jobs_version) and \
+                    not HeartBeat._jobs_wait_callback(msf_jobs_dict):
+                return result
+        jobs = Job.list_jobs(msf_jobs_dict, fetched=True)
+        HeartBeat._update_section(result, "jobs", jobs_version, jobs)
+        return result
 
-        # result_history
-        result_history = PostModuleResultHistory.list_all()
-        for one in result_history:
-            for host in hosts_sorted:
-                if one.get("hid") == host.get("id"):
-                    one["ipaddress"] = host.get("ipaddress")
-                    break
+    @staticmethod
+    def _produce_hosts_sorted(versions):
+        # session信息来自msfrpc,无版本号,每次重新聚合
+        result = {}
+        hosts_sorted = HeartBeat.list_hostandsession(HeartBeat._get_hosts(versions), track=True)
+        HeartBeat._update_section(result, "hosts_sorted", versions.get(Xcache.DATA_VERSION_HOSTS, 0), hosts_sorted)
+        return result
 
-        cache_result_history = Xcache.get_heartbeat_cache_result_history()
+    @staticmethod
+    def _produce_result_history(versions):
+        # 依赖主机的ipaddress,使用数据库中的主机列表,不等待session
+        result = {}
+        result_history_version = (versions.get(Xcache.DATA_VERSION_RESULT_HISTORY, 0),
+                                  versions.get(Xcache.DATA_VERSION_HOSTS, 0))
+        if HeartBeat._section_unchanged("result_history", result_history_version):
+            return result
+        result_history = PostModuleResultHistory.list_all()
+        HeartBeat.attach_result_history_ipaddress(result_history, HeartBeat._get_hosts(versions))
+        HeartBeat._update_section(result, "result_history", result_history_version, result_history)
+        return result
 
-        if cache_result_history == result_history:
-            result["result_history_update"] = False
-            result["result_history"] = []
+    @staticmethod
+    def _produce_notices(versions):
+        # 增量模式只发送上次发布之后新增的通知,全量模式发送完整列表(notices_full)
+        # 通知被清空时发送notices_clean,客户端清空列表后使用本次的notices
+        result = {}
+        notices_version = (versions.get(Xcache.DATA_VERSION_NOTICES, 0),
+                           versions.get(Xcache.DATA_VERSION_NOTICES_CLEAN, 0))
+        last_version = HeartBeat._section_versions.get("notices")
+        if last_version == notices_version:
+            return result
+        HeartBeat._section_versions["notices"] = notices_version
+        notices_full = Notice.list_notices()
+        HeartBeat._snapshot_notices = notices_full
+        if last_version is not None and last_version[1] != notices_version[1]:
+            notices = notices_full
+            notices_from_id = None
+            result["notices_clean"] = True
         else:
-            Xcache.set_heartbeat_cache_result_history(result_history)
-            result["result_history_update"] = True
-            result["result_history"] = result_history
-
-        # notices
-        notices = Notice.list_notices()
-        cache_notices = Xcache.get_heartbeat_cache_notices()
-        if cache_notices == notices:
-            result["notices_update"] = False
-            result["notices"] = []
+            notices_from_id = Xcache.get_heartbeat_cache_notices_last_id()
+            notices = Notice.list_notices_after(notices_from_id)
+            if len(notices) == 0:
+                return result
+        if len(notices) > 0:
+            notices_last_id = notices[0].get("id")
         else:
-            Xcache.set_heartbeat_cache_notices(notices)
-            result["notices_update"] = True
-            result["notices"] = notices
+            notices_last_id = Notice.get_last_id()
+        Xcache.set_heartbeat_cache_notices_last_id(notices_last_id)
+        result["notices_update"] = True
+        result["notices"] = notices
+        result["notices_full"] = notices_full
+        result["notices_from_id"] = notices_from_id
+        result["notices_last_id"] = notices_last_id
+        return result
 
-        # 任务队列长度
+    @staticmethod
+    def _produce_bot_wait_list(versions):
+        result = {}
+        bot_wait_version = versions.get(Xcache.DATA_VERSION_BOT_WAIT, 0)
+        if HeartBeat._section_unchanged("bot_wait_list", bot_wait_version):
+            return result
+        bot_wait_list = Job.list_bot_wait()
+        HeartBeat._update_section(result, "bot_wait_list", bot_wait_version, bot_wait_list)
+        return result
+
+    @staticmethod
+    def _produce_task_queue_length(versions):
+        result = {}
+        task_version = versions.get(Xcache.DATA_VERSION_MODULE_TASK, 0)
+        if HeartBeat._section_unchanged("task_queue_length", task_version):
+            return result
+        HeartBeat._section_versions["task_queue_length"] = task_version
         task_queue_length = Xcache.get_module_task_length()
-        result["task_queue_length"] = task_queue_length
+        if HeartBeat._section_results.get("task_queue_length") != task_queue_length:
+            HeartBeat._section_results["task_queue_length"] = task_queue_length
+            result["task_queue_length"] = task_queue_length
+        return result
 
-        # bot_wait_list 列表
-        bot_wait_list = Job.list_bot_wait()
-        cache_bot_wait_list = Xcache.get_heartbeat_cache_bot_wait_list()
-        if cache_bot_wait_list == bot_wait_list:
-            result["bot_wait_list_update"] = False
-            result["bot_wait_list"] = []
+    @staticmethod
+    def _produce_msfrpc_status(versions):
+        # 监控进程的msfrpc熔断状态,变化时发送
+        result = {}
+        msfrpc_status = RpcBreaker.status()
+        if HeartBeat._section_results.get("msfrpc_status") != msfrpc_status:
+            HeartBeat._section_results["msfrpc_status"] = msfrpc_status
+            result["msfrpc_status"] = msfrpc_status
+        return result
+
+    @staticmethod
+    def entity_key(section, entity):
+        """增量模式下实体的key,host按 "hid-sessionid" (无session时为 "hid-"),其他按id"""
+        if section == "hosts_sorted":
+            session = entity.get("session")
+            if session is None:
+                return f"{entity.get('id')}-"
+            return f"{entity.get('id')}-{session.get('id')}"
+        return str(entity.get("id"))
+
+    @staticmethod
+    def _diff_section(section, data):
+        """与上次发送的实体比较,生成JSON-patch风格的add/replace/remove操作
+        order_id不参与比较,顺序变化时单独发送一次key列表
+        session的last_checkin/fromnow不参与比较,变化时单独发送一次 {key: [last_checkin, fromnow]}
+        """
+        old_entities = HeartBeat._delta_entities.get(section, {})
+        old_checkins = HeartBeat._delta_checkins.get(section, {})
+        new_entities = {}
+        new_checkins = {}
+        patch = []
+        for entity in data:
+            key = HeartBeat.entity_key(section, entity)
+            value = {k: v for k, v in entity.items() if k != "order_id"}
+            compare_value = value
+            session = value.get("session") if section == "hosts_sorted" else None
+            if session is not None:
+                new_checkins[key] = [session.get("last_checkin"), session.get("fromnow")]
+                compare_value = dict(value, session={k: v for k, v in session.items()
+                                                     if k not in HeartBeat.VOLATILE_SESSION_FIELDS})
+            new_entities[key] = compare_value
+            old_value = old_entities.get(key)
+            if old_value is None:
+                patch.append({"op": "add", "path": f"/{section}/{key}", "value": value})
+            elif old_value != compare_value:
+                patch.append({"op": "replace", "path": f"/{section}/{key}", "value": value})
+        for key in old_entities:
+            if key not in new_entities:
+                patch.append({"op": "remove", "path": f"/{section}/{key}"})
+        if list(old_entities.keys()) != list(new_entities.keys()):
+            patch.append({"op": "replace", "path": f"/{section}_order", "value": list(new_entities.keys())})
+        if new_checkins != old_checkins:
+            patch.append({"op": "replace", "path": f"/{section}_checkin", "value": new_checkins})
+        HeartBeat._delta_entities[section] = new_entities
+        HeartBeat._delta_checkins[section] = new_checkins
+        return patch
+
+    @staticmethod
+    def full_message(message):
+        """全量模式消息,去掉增量字段
+        兼容原有客户端,每条消息都携带task_queue_length,仅增量模式在变化时发送
+        """
+        message = dict(message)
+        message.pop("patch", None)
+        message.pop("seq", None)
+        if "notices_full" in message:
+            message["notices"] = message.pop("notices_full")
+        if "task_queue_length" not in message:
+            task_queue_length = HeartBeat._section_results.get("task_queue_length")
+            if task_queue_length is None:
+                task_queue_length = Xcache.get_module_task_length()
+            message["task_queue_length"] = task_queue_length
+        return message
+
+    @staticmethod
+    def delta_message(message):
+        """增量模式消息,hosts_sorted及result_history只发送变化的实体"""
+        message = dict(message)
+        message.pop("notices_full", None)
+        for section in HeartBeat.DELTA_SECTIONS:
+            message.pop(section, None)
+            message.pop(f"{section}_update", None)
+        message["mode"] = "delta"
+        return message
+
+    @staticmethod
+    def encode_message(result):
+        """每次发布只编码一次,全量/增量两种文本帧由各客户端直接转发
+        同时携带通知及序号字段,客户端需要补齐通知或重新同步时使用
+        """
+        event = {
+            'type': 'send.message',
+            'full': json.dumps(HeartBeat.full_message(result)),
+            'delta': json.dumps(HeartBeat.delta_message(result)),
+            'notices_update': result.get("notices_update"),
+            'notices_clean': result.get("notices_clean"),
+            'notices_from_id': result.get("notices_from_id"),
+            'notices_last_id': result.get("notices_last_id"),
+            'seq': result.get("seq"),
+        }
+        return event
+
+    @staticmethod
+    def _snapshot_fields(section):
+        """快照中对应部分的字段,值为编码后的JSON"""
+        if section == "notices":
+            if HeartBeat._snapshot_notices is None:
+                HeartBeat._snapshot_notices = Notice.list_notices()
+            notices = HeartBeat._snapshot_notices
+            if len(notices) > 0:
+                notices_last_id = notices[0].get("id")
+            else:
+                notices_last_id = Notice.get_last_id()
+            return {"notices": json.dumps(notices), "notices_last_id": json.dumps(notices_last_id)}
+        return {section: json.dumps(HeartBeat._section_results.get(section))}
+
+    @staticmethod
+    def update_snapshot(section, seq=None):
+        """保存最近一次的全量心跳及其对应的序号,供新连接的客户端直接使用
+        快照按部分分字段保存,只重新编码本次变化的部分,读取时再拼接为全量消息
+        所有部分都计算过一次后才写入,必须在广播该序号之前写入
+        """
+        if not HeartBeat._snapshot_ready:
+            for one in HeartBeat.SECTION_FAMILIES:
+                if one != "notices" and one not in HeartBeat._section_results:
+                    return
+            sections = list(HeartBeat.SECTION_FAMILIES.keys())
         else:
-            Xcache.set_heartbeat_cache_bot_wait_list(bot_wait_list)
-            result["bot_wait_list_update"] = True
-            result["bot_wait_list"] = bot_wait_list
+            sections = [section]
+        fields = {"seq": json.dumps(seq)}
+        for one in sections:
+            fields.update(HeartBeat._snapshot_fields(one))
+        Xcache.set_heartbeat_snapshot(fields)
+        HeartBeat._snapshot_ready = True
 
-        return result
+    @staticmethod
+    def read_snapshot(max_age):
+        """读取快照并拼接为全量模式的文本帧,返回{"seq", "notices_last_id", "data"},没有或过期时返回None"""
+        fields = Xcache.get_heartbeat_snapshot(max_age)
+        if fields is None:
+            return None
+        parts = ['"mode": "full"', f'"seq": {fields.get("seq")}']
+        for section in HeartBeat.SNAPSHOT_UPDATE_SECTIONS:
+            parts.append(f'"{section}_update": true')
+            parts.append(f'"{section}": {fields.get(section, "null")}')
+        for key in ["notices_last_id", "task_queue_length", "msfrpc_status"]:
+            parts.append(f'"{key}": {fields.get(key, "null")}')
+        return {"seq": json.loads(fields.get("seq")),
+                "notices_last_id": json.loads(fields.get("notices_last_id", "null")),
+                "data": "{" + ", ".join(parts) + "}"}
+
+    @staticmethod
+    def run_section(section, versions=None):
+        """计算一个部分,有变化时独立发布到websocket组,返回是否有变化"""
+        with HeartBeat._section_locks[section]:
+            if versions is None:
+                versions = Xcache.get_data_versions()
+            result = getattr(HeartBeat, f"_produce_{section}")(versions)
+            if len(result) > 0:
+                with HeartBeat._publish_lock:
+                    patch = []
+                    if section in HeartBeat.DELTA_SECTIONS:
+                        patch = HeartBeat._diff_section(section, result.get(section))
+                    HeartBeat._delta_seq += 1
+                    result["seq"] = HeartBeat._delta_seq
+                    result["patch"] = patch
+                    # 先写入快照再广播,期间连接的客户端以快照序号为基准,不会漏掉本次patch
+                    HeartBeat.update_snapshot(section, HeartBeat._delta_seq)
+                    channel_layer = get_channel_layer()
+                    async_to_sync(channel_layer.group_send)("heartbeat", HeartBeat.encode_message(result))
+            if HeartBeat._snapshot_ready:
+                Xcache.set_heartbeat_snapshot_time(time.time())
+            return len(result) > 0
+
+    @staticmethod
+    def _reset_poll(section):
+        HeartBeat._poll_state[section] = {"interval": 1, "idle": 0, "wait": 0}
+
+    @staticmethod
+    def _check_subscribers():
+        """返回是否有客户端连接,新客户端连接时轮询部分恢复为每秒一次,从无到有时刷新事件部分"""
+        subscribers = Xcache.get_heartbeat_subscriber_count()
+        with HeartBeat._subscribers_lock:
+            last_subscribers = HeartBeat._subscribers
+            HeartBeat._subscribers = subscribers
+        if subscribers == 0:
+            return False
+        if subscribers > last_subscribers:
+            for section in HeartBeat.POLLED_SECTIONS:
+                HeartBeat._reset_poll(section)
+            if last_subscribers == 0:
+                versions = Xcache.get_data_versions()
+                for section in HeartBeat.EVENT_SECTIONS:
+                    HeartBeat.run_section(section, versions)
+        return True
+
+    @staticmethod
+    def poll(section):
+        """轮询部分的定时入口(每秒一次),无客户端时不计算,连续无变化时间隔加倍"""
+        if not HeartBeat._check_subscribers():
+            return
+        state = HeartBeat._poll_state.get(section)
+        if state is None:
+            HeartBeat._reset_poll(section)
+            state = HeartBeat._poll_state.get(section)
+        if state["wait"] > 0:
+            state["wait"] -= 1
+            return
+
+        if HeartBeat.run_section(section):
+            state["interval"] = 1
+            state["idle"] = 0
+        else:
+            state["idle"] += 1
+            if state["idle"] >= HEARTBEAT_IDLE_TICKS:
+                state["interval"] = min(state["interval"] * 2, HEARTBEAT_MAX_INTERVAL)
+                state["idle"] = 0
+        state["wait"] = state["interval"] - 1
+
+    @staticmethod
+    def check_events():
+        """事件部分的兜底检查(订阅消息丢失时),没有客户端连接时只执行必要的后台检查
+        同时通知所有客户端续期登记,已断开但未清理的登记过期后不再计数
+        """
+        channel_layer = get_channel_layer()
+        async_to_sync(channel_layer.group_send)("heartbeat", {'type': 'subscriber.refresh'})
+        if not HeartBeat._check_subscribers():
+            HeartBeat.background_check()
+            return
+        versions = Xcache.get_data_versions()
+        for section in HeartBeat.EVENT_SECTIONS:
+            HeartBeat.run_section(section, versions)
+
+    @staticmethod
+    def on_data_version_changed(message):
+        """数据版本号变化事件:事件部分合并短时间内的多次事件后计算发布,轮询部分恢复为每秒一次"""
+        family = message.get('data')
+        if isinstance(family, bytes):
+            family = family.decode('utf-8')
+        if HeartBeat._subscribers == 0:
+            return
+        for section, families in HeartBeat.SECTION_FAMILIES.items():
+            if family not in families:
+                continue
+            if section in HeartBeat.POLLED_SECTIONS:
+                HeartBeat._reset_poll(section)
+            else:
+                HeartBeat._schedule_section(section)
+
+    @staticmethod
+    def _schedule_section(section):
+        """HEARTBEAT_EVENT_DEBOUNCE秒后计算该部分,期间的多次事件(如连续发送的通知)合并为一次计算"""
+        with HeartBeat._pending_lock:
+            if section in HeartBeat._pending_sections:
+                return
+            HeartBeat._pending_sections.add(section)
+        timer = threading.Timer(HEARTBEAT_EVENT_DEBOUNCE, HeartBeat._run_pending_section, args=(section,))
+        timer.daemon = True
+        timer.start()
 
     @staticmethod
-    def list_hostandsession():
-        hosts = Host.list_hosts()
-        sessions = HeartBeat.list_sessions()
+    def _run_pending_section(section):
+        # 计算前移出待执行集合,计算期间的新事件会再安排一次计算
+        with HeartBeat._pending_lock:
+            HeartBeat._pending_sections.discard(section)
+        try:
+            HeartBeat.run_section(section)
+        except Exception as E:
+            logger.exception(E)
 
+    @staticmethod
+    def background_check():
+        """没有客户端连接时只执行必要的检查:清理失效任务,session事件"""
+        Job.list_jobs()
+        HeartBeat.list_sessions(track=True)
+
+    @staticmethod
+    def list_hostandsession(hosts=None, track=False):
+        if hosts is None:
+            hosts = Host.list_hosts()
+        sessions = HeartBeat.list_sessions(track)
+        return HeartBeat.join_hosts_sessions(hosts, sessions)
+
+    @staticmethod
+    def join_hosts_sessions(hosts, sessions):
+        """聚合Session和host,每个session一条记录,没有session的host追加在后面
+        按ipaddress/hid建立索引,复杂度O(H+S)
+        """
         # 初始化session列表
+        host_by_ipaddress = {}
         for host in hosts:
             host['session'] = None
+            host_by_ipaddress.setdefault(host.get('ipaddress'), host)
 
         hosts_with_session = []
+        hids_with_session = set()
 
-        # 聚合Session和host
-        host_exist = False
         for session in sessions:
-            for host in hosts:
-                if session.get("session_host") == host.get('ipaddress'):
-                    temp_host = copy.deepcopy(host)
-                    temp_host['session'] = session
-                    hosts_with_session.append(temp_host)
-                    host_exist = True
-                    break
-
-            if host_exist is True:
-                host_exist = False
+            session_host = session.get("session_host")
+            host = host_by_ipaddress.get(session_host)
+            if host is not None:
+                # host中没有嵌套结构,浅拷贝即可
+                temp_host = dict(host)
+                temp_host['session'] = session
+                hosts_with_session.append(temp_host)
+                hids_with_session.add(host.get("id"))
+            elif session_host is None or session_host == "":
+                continue
             else:
-                if session.get("session_host") is None or session.get("session_host") == "":
-                    host_exist = False
+                # 减少新建无效的host
+                if session.get("available"):
+                    host_create = Host.create_host(session_host)
                 else:
-                    # 减少新建无效的host
-                    if session.get("available"):
-                        host_create = Host.create_host(session.get("session_host"))
-                    else:
-                        host_create = Host.create_host("255.255.255.255")
-                    host_create['session'] = session
-                    hosts_with_session.append(host_create)
-                    host_exist = False
+                    host_create = Host.create_host("255.255.255.255")
+                host_by_ipaddress.setdefault(host_create.get('ipaddress'), dict(host_create))
+                host_create['session'] = session
+                hosts_with_session.append(host_create)
+                hids_with_session.add(host_create.get("id"))
 
         for host in hosts:
-            add = True
-            for temp_host in hosts_with_session:
-                if temp_host.get("id") == host.get("id"):
-                    add = False
-                    break
-            if add:
+            if host.get("id") not in hids_with_session:
                 hosts_with_session.append(host)
 
-        # 设置host的proxy信息
-        # 收集所有hostip
-        ipaddress_list = []
-        for host in hosts_with_session:
-            ipaddress_list.append(host.get('ipaddress'))
-
-        i = 0
-        for one in hosts_with_session:
-            one["order_id"] = i
-            i += 1
+        for order_id, one in enumerate(hosts_with_session):
+            one["order_id"] = order_id
 
         return hosts_with_session
 
     @staticmethod
-    def list_sessions():
+    def attach_result_history_ipaddress(result_history, hosts_sorted):
+        """按hid索引为历史结果补充ipaddress"""
+        ipaddress_by_hid = {}
+        for host in hosts_sorted:
+            ipaddress_by_hid.setdefault(host.get("id"), host.get("ipaddress"))
+        for one in result_history:
+            hid = one.get("hid")
+            if hid in ipaddress_by_hid:
+                one["ipaddress"] = ipaddress_by_hid.get(hid)
+        return result_history
+
+    @staticmethod
+    def _transform_session(sid, info, tunnel_peer_locate):
+        """session中只随原始信息变化的部分,结果按(sid, 指纹)缓存
+        last_checkin/fromnow/job_info每次重新计算
+        """
+        one_session = {'id': sid}
+
+        # 处理linux的no-user问题
+        session_info = info.get('info')
+        if str(session_info).split(' @ ')[0] == "no-user":
+            session_info = session_info[10:]
+
+        one_session['type'] = info.get('type')
+        one_session['session_host'] = info.get('session_host')
+        one_session['tunnel_local'] = info.get('tunnel_local')
+        one_session['tunnel_peer'] = info.get('tunnel_peer')
+        one_session['tunnel_peer_ip'] = info.get('tunnel_peer').split(":")[0]
+        one_session['tunnel_peer_locate'] = tunnel_peer_locate
+        one_session['via_exploit'] = info.get('via_exploit')
+        one_session['exploit_uuid'] = info.get('exploit_uuid')
+        one_session['via_payload'] = info.get('via_payload')
+        one_session['uuid'] = info.get('uuid')
+        one_session['platform'] = info.get('platform')
+        one_session['info'] = session_info
+        one_session['arch'] = info.get('arch')
+        try:
+            one_session['user'] = str(session_info).split(' @ ')[0]
+            one_session['computer'] = str(session_info).split(' @ ')[1]
+        except Exception as _:
+            one_session['user'] = "Initializing"
+            one_session['computer'] = "Initializing"
+            one_session['advanced_info'] = {"sysinfo": {}, "username": "Initializing"}
+            one_session['os'] = None
+            one_session['load_powershell'] = False
+            one_session['load_python'] = False
+            one_session['routes'] = []
+            one_session['isadmin'] = False
+            one_session['available'] = False  # 是否初始化完成
+            return one_session
+
+        one_session['load_powershell'] = info.get('load_powershell')
+        one_session['load_python'] = info.get('load_python')
+
+        one_session['advanced_info'] = info.get('advanced_info')
+        try:
+            one_session['os'] = info.get('advanced_info').get("sysinfo").get("OS")
+            one_session['os_short'] = info.get('advanced_info').get("sysinfo").get("OS").split("(")[0]
+        except Exception as _:
+            one_session['os'] = None
+            one_session['os_short'] = None
+        try:
+            one_session['isadmin'] = info.get('advanced_info').get("sysinfo").get("IsAdmin")
+            if info.get('platform').lower().startswith('linux'):
+                if "uid=0" in one_session['info'].lower():
+                    one_session['isadmin'] = True
+        except Exception as _:
+            one_session['isadmin'] = None
+
+        routestrlist = info.get('routes')
+        one_session['routes'] = []
+        try:
+            if isinstance(routestrlist, list):
+                for routestr in routestrlist:
+                    tmpdict = {"subnet": routestr.split('/')[0], 'netmask': routestr.split('/')[1]}
+                    one_session['routes'].append(tmpdict)
+        except Exception as E:
+            logger.error(E)
+        one_session['available'] = True
+        return one_session
+
+    @staticmethod
+    def list_sessions(track=False):
+        """track为True时(仅监控进程)与上次结果比较,生成session生命周期事件"""
+        # JobList与SessionList一次批量请求获取,同时刷新msf任务缓存
+        msfjobs, infos = RpcClient.call_batch([(Method.JobList, None), (Method.SessionList, None)], timeout=3)
+        Xcache.set_msf_job_cache(msfjobs)
+
         uuid_msfjobid = {}
-        msfjobs = Job.list_msfrpc_jobs()
         if msfjobs is not None:
             for jobid in msfjobs:
                 datastore = msfjobs[jobid].get("datastore")
@@ -202,107 +671,63 @@ class HeartBeat(object):
                                                              "LHOST": datastore.get("LHOST"),
                                                              "RHOST": datastore.get("RHOST")}
 
-        sessions_available_count = 0
         sessions = []
-        infos = RpcClient.call(Method.SessionList, timeout=3)
         if infos is None:
             return sessions
 
         if infos.get('error'):
             logger.warning(infos.get('error_string'))
             return sessions
-        sessionhosts = []
-        for key in infos.keys():
+
+        fingerprints = {}
+        for key, info in infos.items():
+            if isinstance(info, dict):
+                fingerprints[key] = SessionTracker.fingerprint(info)
+
+        if track:
+            SessionTracker.update(infos, fingerprints)
+
+        # 未变化的session直接使用缓存,只对新增或变化的session查询ip归属地
+        session_cache = HeartBeat._session_cache
+        tunnel_peer_ips = []
+        for key, fingerprint in fingerprints.items():
+            cached = session_cache.get(key)
+            if cached is None or cached[0] != fingerprint:
+                tunnel_peer = infos.get(key).get('tunnel_peer')
+                if tunnel_peer is not None:
+                    tunnel_peer_ips.append(tunnel_peer.split(":")[0])
+        tunnel_peer_locates = Geoip.lookup_many(tunnel_peer_ips)
+
+        new_session_cache = {}
+        now = int(time.time())
+        for key, fingerprint in fingerprints.items():
             info = infos.get(key)
-            if info is not None:
-                one_session = {}
+            cached = session_cache.get(key)
+            if cached is not None and cached[0] == fingerprint:
+                base_session = cached[1]
+            else:
                 try:
-                    one_session['id'] = int(key)
+                    sid = int(key)
                 except Exception as E:
                     logger.warning(E)
                     continue
-
-                # 处理linux的no-user问题
-                if str(info.get('info')).split(' @ ')[0] == "no-user":
-                    info['info'] = info.get('info')[10:]
-
-                one_session['type'] = info.get('type')
-                one_session['session_host'] = info.get('session_host')
-                one_session['tunnel_local'] = info.get('tunnel_local')
-                one_session['tunnel_peer'] = info.get('tunnel_peer')
-                one_session['tunnel_peer_ip'] = info.get('tunnel_peer').split(":")[0]
-                one_session['tunnel_peer_locate'] = Geoip.get_city(info.get('tunnel_peer').split(":")[0])
-                one_session['via_exploit'] = info.get('via_exploit')
-                one_session['exploit_uuid'] = info.get('exploit_uuid')
-
-                if uuid_msfjobid.get(info.get('exploit_uuid')) is None:
-                    one_session['job_info'] = {"job_id": -1,
-                                               "PAYLOAD": None,
-                                               "LPORT": None,
-                                               "LHOST": None,
-                                               "RHOST": None}
-                else:
-                    one_session['job_info'] = uuid_msfjobid.get(info.get('exploit_uuid'))
-
-                one_session['via_payload'] = info.get('via_payload')
-                one_session['tunnel_peer_ip'] = info.get('tunnel_peer').split(":")[0]
-                one_session['tunnel_peer_locate'] = Geoip.get_city(info.get('tunnel_peer').split(":")[0])
-                one_session['uuid'] = info.get('uuid')
-                one_session['platform'] = info.get('platform')
-                one_session['last_checkin'] = info.get('last_checkin') // 5 * 5
-                one_session['fromnow'] = (int(time.time()) - info.get('last_checkin')) // 5 * 5
-                one_session['info'] = info.get('info')
-                one_session['arch'] = info.get('arch')
-                try:
-                    one_session['user'] = str(info.get('info')).split(' @ ')[0]
-                    one_session['computer'] = str(info.get('info')).split(' @ ')[1]
-                except Exception as _:
-                    one_session['user'] = "Initializing"
-                    one_session['computer'] = "Initializing"
-                    one_session['advanced_info'] = {"sysinfo": {}, "username": "Initializing"}
-                    one_session['os'] = None
-                    one_session['load_powershell'] = False
-                    one_session['load_python'] = False
-                    one_session['routes'] = []
-                    one_session['isadmin'] = False
-                    one_session['available'] = False  # 是否初始化完成
-                    sessions.append(one_session)
-                    continue
-
-                one_session['load_powershell'] = info.get('load_powershell')
-                one_session['load_python'] = info.get('load_python')
-
-                one_session['advanced_info'] = info.get('advanced_info')
-                try:
-                    one_session['os'] = info.get('advanced_info').get("sysinfo").get("OS")
-                    one_session['os_short'] = info.get('advanced_info').get("sysinfo").get("OS").split("(")[0]
-                except Exception as _:
-                    one_session['os'] = None
-                    one_session['os_short'] = None
-                try:
-                    one_session['isadmin'] = info.get('advanced_info').get("sysinfo").get("IsAdmin")
-                    if info.get('platform').lower().startswith('linux'):
-                        if "uid=0" in one_session['info'].lower():
-                            one_session['isadmin'] = True
-                except Exception as _:
-                    one_session['isadmin'] = None
-
-                routestrlist = info.get('routes')
-                one_session['routes'] = []
-                try:
-                    if isinstance(routestrlist, list):
-                        for routestr in routestrlist:
-                            routestr.split('/')
-                            tmpdict = {"subnet": routestr.split('/')[0], 'netmask': routestr.split('/')[1]}
-                            one_session['routes'].append(tmpdict)
-                except Exception as E:
-                    logger.error(E)
-                one_session['available'] = True
-                sessions.append(one_session)
-
-                # session监控统计信息
-                sessionhosts.append(info.get('session_host'))
-                sessions_available_count += 1
+                base_session = HeartBeat._transform_session(
+                    sid, info, tunnel_peer_locates.get(info.get('tunnel_peer').split(":")[0]))
+            new_session_cache[key] = (fingerprint, base_session)
+            one_session = dict(base_session)
+
+            one_session['last_checkin'] = info.get('last_checkin') // 5 * 5
+            one_session['fromnow'] = (now - info.get('last_checkin')) // 5 * 5
+            if uuid_msfjobid.get(info.get('exploit_uuid')) is None:
+                one_session['job_info'] = {"job_id": -1,
+                                           "PAYLOAD": None,
+                                           "LPORT": None,
+                                           "LHOST": None,
+                                           "RHOST": None}
+            else:
+                one_session['job_info'] = uuid_msfjobid.get(info.get('exploit_uuid'))
+            sessions.append(one_session)
+        HeartBeat._session_cache = new_session_cache
 
         def split_ip(ip):
             try:
@@ -316,12 +741,4 @@ class HeartBeat(object):
             return split_ip(item.get("session_host"))
 
         sessions = sorted(sessions, key=session_host_key)
-
-        # session监控功能
-        if Xcache.get_sessionmonitor_conf().get("flag"):
-            if Xcache.get_session_count() < sessions_available_count:
-                Notice.send_sms(f"当前Session数量: {sessions_available_count} IP列表: {','.join(sessionhosts)}")
-                Notice.send_info(f"当前Session数量: {sessions_available_count}")
-            if Xcache.get_session_count() != sessions_available_count:
-                Xcache.set_session_count(sessions_available_count)
         return sessions
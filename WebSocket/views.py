@@ -5,7 +5,9 @@ from asgiref.sync import async_to_sync
 from channels.generic.websocket import WebsocketConsumer
 from django.http.request import QueryDict
 
+from Lib.configs import HEARTBEAT_SNAPSHOT_MAX_AGE
 from Lib.log import logger
+from Lib.notice import Notice
 from Lib.xcache import Xcache
 from WebSocket.Handle.console import Console
 from WebSocket.Handle.heartbeat import HeartBeat
@@ -183,12 +185,16 @@ class MsfConsoleView(WebsocketConsumer):
 
 
 class HeartBeatView(WebsocketConsumer):
+    notices_last_id = None  # 当前客户端已收到的最新通知id
+    delta = False  # 是否为增量模式(连接参数 mode=delta)
+    delta_seq = None  # 增量模式下客户端已收到的最新序号
+    authenticated = False  # token校验通过后才加入心跳组及响应客户端请求
+
     def connect(self):
         """
         打开 websocket 连接
         :return:
         """
-        async_to_sync(self.channel_layer.group_add)("heartbeat", self.channel_name)
         self.accept()
 
         query_string = self.scope.get('query_string')
@@ -196,18 +202,80 @@ class HeartBeatView(WebsocketConsumer):
 
         token = ssh_args.get('token')
         if Xcache.alive_token(token):
-            result = HeartBeat.first_heartbeat_result()
-            self.send(json.dumps(result))
+            self.authenticated = True
+            async_to_sync(self.channel_layer.group_add)("heartbeat", self.channel_name)
+            Xcache.add_heartbeat_subscriber(self.channel_name)
+            self.delta = ssh_args.get('mode') == "delta"
+            self.send_full_result()
             return
         else:
-            self.disconnect()
+            self.close()
 
     def disconnect(self, close_code=0):
         try:
             async_to_sync(self.channel_layer.group_discard)("heartbeat", self.channel_name)
+            Xcache.del_heartbeat_subscriber(self.channel_name)
         except:
             pass
 
+    def send_full_result(self):
+        """发送全量数据,增量模式下客户端以此为基准应用后续patch
+        优先使用监控进程最近的快照,快照过期(无客户端时心跳暂停)才重新计算
+        """
+        snapshot = HeartBeat.read_snapshot(HEARTBEAT_SNAPSHOT_MAX_AGE)
+        if snapshot is not None:
+            # 快照已包含其序号及之前的所有patch
+            self.notices_last_id = snapshot.get("notices_last_id")
+            self.delta_seq = snapshot.get("seq")
+            self.send(snapshot.get("data"))
+            return
+
+        result = HeartBeat.first_heartbeat_result()
+        self.notices_last_id = result.get("notices_last_id")
+        if self.delta:
+            result["mode"] = "full"
+            result["seq"] = self.delta_seq
+        self.send(json.dumps(result))
+
+    def receive(self, text_data=None, bytes_data=None):
+        """增量模式下客户端检测到序号不连续时请求全量同步"""
+        if not self.authenticated:
+            return
+        try:
+            message = json.loads(text_data)
+        except Exception as E:
+            logger.warning(E)
+            return
+        if message.get("action") == "resync":
+            self.send_full_result()
+
+    def subscriber_refresh(self, event):
+        """监控进程定期发送,续期本客户端的登记"""
+        Xcache.add_heartbeat_subscriber(self.channel_name)
+
     def send_message(self, event):
-        message = event['message']
-        self.send(json.dumps(message))
+        """心跳已在监控进程中编码为文本帧,直接转发"""
+        if self.delta:
+            seq = event.get("seq")
+            if self.delta_seq is not None and seq == self.delta_seq:
+                # 快照已包含该次变化(快照写入后,广播前连接的客户端)
+                return
+            if self.delta_seq is not None and seq != self.delta_seq + 1:
+                # 序号不连续(消息丢失或心跳进程重启),重新发送全量数据
+                self.delta_seq = seq
+                self.send_full_result()
+                return
+            self.delta_seq = seq
+            text_data = event['delta']
+        else:
+            text_data = event['full']
+
+        if event.get("notices_update"):
+            if self.delta and not event.get("notices_clean") and \
+                    self.notices_last_id != event.get("notices_from_id"):
+                # 广播的起点与客户端不一致(刚连接或漏收),单独补齐该客户端未收到的通知
+                message = json.loads(text_data)
+                message["notices"] = Notice.list_notices_after(self.notices_last_id)
+                text_data = json.dumps(message)
+            self.notices_last_id = event.get("notices_last_id")
+        self.send(text_data)
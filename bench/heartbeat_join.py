@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File  : heartbeat_join.py
+# @Date  : 2021/3/5
+# @Desc  : 心跳中host/session聚合的单次耗时测试,对比原嵌套循环实现与索引实现(1000个host,200个session)
+#          在仓库根目录执行: python bench/heartbeat_join.py
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Viper.settings')
+
+import django
+
+django.setup()
+
+from Core.Handle.host import Host
+from WebSocket.Handle.heartbeat import HeartBeat
+
+
+def build_hosts(count):
+    hosts = []
+    for i in range(count):
+        hosts.append({"id": i + 1,
+                      "ipaddress": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+                      "tag": "other",
+                      "comment": None})
+    return hosts
+
+
+def build_sessions(hosts, count):
+    sessions = []
+    for i, host in enumerate(random.sample(hosts, count)):
+        sessions.append({"id": i + 1,
+                         "type": "meterpreter",
+                         "session_host": host.get("ipaddress"),
+                         "tunnel_peer": f"{host.get('ipaddress')}:4444",
+                         "platform": "windows",
+                         "available": True,
+                         "fromnow": 5,
+                         "advanced_info": {"sysinfo": {"OS": "Windows 10 (10.0 Build 19041).",
+                                                       "Computer": f"PC-{i}"},
+                                           "username": "viper\\admin"},
+                         "routes": [{"subnet": "10.0.0.0", "netmask": "255.255.255.0"}]})
+    return sessions
+
+
+def build_result_history(hosts, count):
+    result_history = []
+    for i in range(count):
+        host = random.choice(hosts)
+        result_history.append({"id": f"{1614902400000 + i}-0",
+                               "hid": host.get("id"),
+                               "loadpath": "MODULES.DefenseEvasion_ProcessInjection_SessionClone",
+                               "update_time": 1614902400 + i,
+                               "result": "x" * 64})
+    return result_history
+
+
+def old_join_hosts_sessions(hosts, sessions):
+    """原HeartBeat.list_hostandsession中的嵌套循环实现,O(H*S)"""
+    # 初始化session列表
+    for host in hosts:
+        host['session'] = None
+
+    hosts_with_session = []
+
+    # 聚合Session和host
+    host_exist = False
+    for session in sessions:
+        for host in hosts:
+            if session.get("session_host") == host.get('ipaddress'):
+                temp_host = copy.deepcopy(host)
+                temp_host['session'] = session
+                hosts_with_session.append(temp_host)
+                host_exist = True
+                break
+
+        if host_exist is True:
+            host_exist = False
+        else:
+            if session.get("session_host") is None or session.get("session_host") == "":
+                host_exist = False
+            else:
+                # 减少新建无效的host
+                if session.get("available"):
+                    host_create = Host.create_host(session.get("session_host"))
+                else:
+                    host_create = Host.create_host("255.255.255.255")
+                host_create['session'] = session
+                hosts_with_session.append(host_create)
+                host_exist = False
+
+    for host in hosts:
+        add = True
+        for temp_host in hosts_with_session:
+            if temp_host.get("id") == host.get("id"):
+                add = False
+                break
+        if add:
+            hosts_with_session.append(host)
+
+    i = 0
+    for one in hosts_with_session:
+        one["order_id"] = i
+        i += 1
+
+    return hosts_with_session
+
+
+def old_attach_result_history_ipaddress(result_history, hosts_sorted):
+    """原HeartBeat中按hid逐个查找host的实现"""
+    for one in result_history:
+        for host in hosts_sorted:
+            if one.get("hid") == host.get("id"):
+                one["ipaddress"] = host.get("ipaddress")
+                break
+    return result_history
+
+
+def old_tick(hosts, sessions, result_history):
+    hosts_sorted = old_join_hosts_sessions([dict(host) for host in hosts], sessions)
+    return hosts_sorted, old_attach_result_history_ipaddress([dict(one) for one in result_history], hosts_sorted)
+
+
+def new_tick(hosts, sessions, result_history):
+    hosts_sorted = HeartBeat.join_hosts_sessions([dict(host) for host in hosts], sessions)
+    return hosts_sorted, HeartBeat.attach_result_history_ipaddress([dict(one) for one in result_history], hosts_sorted)
+
+
+def best_ms(func, number, *args):
+    timer = timeit.Timer(lambda: func(*args), timer=time.perf_counter)
+    runs = timer.repeat(repeat=5, number=number)
+    return min(runs) / number * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="heartbeat host/session join benchmark")
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--history", type=int, default=1000)
+    parser.add_argument("--number", type=int, default=100)
+    args = parser.parse_args()
+
+    random.seed(0)
+    hosts = build_hosts(args.hosts)
+    sessions = build_sessions(hosts, args.sessions)
+    result_history = build_result_history(hosts, args.history)
+
+    # 两种实现在同一份输入上结果应一致(session均能匹配到已有host,不会新建host)
+    if old_tick(hosts, sessions, result_history) != new_tick(hosts, sessions, result_history):
+        print("old and new implementations returned different results")
+        sys.exit(1)
+
+    old = best_ms(old_tick, args.number, hosts, sessions, result_history)
+    new = best_ms(new_tick, args.number, hosts, sessions, result_history)
+    print(f"hosts={args.hosts} sessions={args.sessions} history={args.history}")
+    print(f"join + history per tick (best of 5 x {args.number}):")
+    print(f"  nested loop: {old:.3f} ms")
+    print(f"  indexed:     {new:.3f} ms")
+    print(f"  speedup:     {old / new:.1f}x")
+
+
+if __name__ == '__main__':
+    main()